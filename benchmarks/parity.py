@@ -0,0 +1,81 @@
+"""
+Check that compensate_batch writes, for every G-code file and model, the
+same bytes as the single-file functions compensate_z_uniform and
+compensate_z_3d write for it. Each input is copied to a temporary directory
+first, as the single-file functions write next to their input.
+
+Usage: python benchmarks/parity.py [-m COEFFICIENTS.csv] [gcode files...]
+Exits with status 1 if any output differs.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'libs', 'python-gcode'))
+sys.path.append(ROOT)
+
+import gcode
+import compensate_batch
+import compensate_z_uniform
+import compensate_z_3d
+from stages import LOOKUP_TABLE_PATH, BENCHMARK_COEFFS
+
+def check_parity(gcode_paths, lookup_table_path, model_coefficients_path, work_dir):
+	"""Compensate copies of gcode_paths in work_dir with compensate_batch and
+	with the single-file functions. Returns a list of (file, printer, whether
+	the outputs are identical)."""
+	inputs = []
+	for gcode_path in gcode_paths:
+		path = os.path.join(work_dir, os.path.basename(gcode_path))
+		shutil.copy(gcode_path, path)
+		inputs.append(path)
+	batch_dir = os.path.join(work_dir, 'batch')
+	os.makedirs(batch_dir)
+	compensate_batch.compensate_batch(inputs, {'uniform': lookup_table_path},
+		{'3d': model_coefficients_path}, batch_dir, 1)
+
+	results = []
+	for path in inputs:
+		compensate_z_uniform.compensate_z_uniform(lookup_table_path, path)
+		compensate_z_3d.compensate_z_3d(model_coefficients_path, path)
+		for printer, tag in (('uniform', '_compensated'), ('3d', '_3d_compensated')):
+			with open(gcode.output_filename(path, tag), 'rb') as f:
+				single = f.read()
+			with open(compensate_batch.output_path(path, printer, printer, batch_dir), 'rb') as f:
+				batch = f.read()
+			results.append((path, printer, single == batch))
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(
+		description='Check compensate_batch outputs against the single-file functions.')
+	parser.add_argument('gcode_paths', nargs='*', metavar='GCODE',
+		help='G-code files to check (default: example_files/*.gcode)')
+	parser.add_argument('-m', '--model-3d', default=None, metavar='CSV',
+		help='3D error model coefficients (default: the benchmark coefficients)')
+	args = parser.parse_args()
+
+	paths = args.gcode_paths or sorted(glob.glob(os.path.join(ROOT, 'example_files', '*.gcode')))
+	work_dir = tempfile.mkdtemp(prefix='gcode_parity')
+	try:
+		model_coefficients_path = args.model_3d
+		if model_coefficients_path is None:
+			model_coefficients_path = os.path.join(work_dir, 'coefficients.csv')
+			with open(model_coefficients_path, 'w') as f:
+				f.write(''.join('%r\n' % coeff for coeff in BENCHMARK_COEFFS))
+		results = check_parity(paths, LOOKUP_TABLE_PATH, model_coefficients_path, work_dir)
+	finally:
+		shutil.rmtree(work_dir)
+
+	for path, printer, identical in results:
+		print '%s [%s]: %s' % (os.path.basename(path), printer, 'identical' if identical else 'DIFFERS')
+	if not all(identical for path, printer, identical in results):
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
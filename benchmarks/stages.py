@@ -0,0 +1,246 @@
+"""
+Time each stage of the compensation pipeline separately, on the files in
+example_files/ and/or synthetic G-code of any size:
+  tokenize            gcode.tokenize() on every line
+  parse               Layer objects without splitting moves (Line.__init__)
+  split               Line.split_move() on the moves Layer would split
+  parse_split         Gcode(), i.e. parse and split together
+  parse_compact       Gcode(compact=True)
+  parse_minimal       Gcode(minimal=True)
+  split_adaptive      Layer.split_adaptive() of unsplit layers, with a Compensator3D
+  compensate_uniform  compensate_z_uniform.shift_layers()
+  compensate_3d       Gcode.z_compensate() with a Compensator3D
+  construct           Gcode.construct()
+  construct_compact   Gcode.construct() of compact layers
+  construct_modal     Gcode.construct(modal=True)
+  compensate_minimal  shift_layers() and construct() of minimal layers
+Each input is run in its own process. The peak memory (RSS) reported after
+each stage is cumulative, the peak of that input's run so far rather than
+of the stage alone, so a stage using less than an earlier one repeats its
+peak. Results are written as JSON, and can be compared against an earlier
+run's to spot regressions.
+
+Usage: python benchmarks/stages.py [-o results.json] [-r REPEATS]
+  [-s LAYERSxMOVES ...] [-c baseline.json] [gcode files...]
+"""
+
+import argparse
+import collections
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+try:
+	import resource
+except ImportError: #not available on Windows, peak memory is not reported
+	resource = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'libs', 'python-gcode'))
+sys.path.append(ROOT)
+
+import gcode
+import compensate_z_uniform
+import compensate_z_3d
+
+LOOKUP_TABLE_PATH = os.path.join(ROOT, 'model_fitting', 'piecewise_compensation_lookup.csv')
+
+#3D model coefficients to benchmark with, as no fitted model ships with the repository
+BENCHMARK_COEFFS = [0.0123, 0.000137, -0.000211, 0.000319, 1.3e-06, 2.7e-07, -1.1e-06, 1.9e-07,
+	-1.3e-07, -1.7e-06, 1.1e-09, -2.3e-09, 3.1e-09, -1.7e-09, 2.9e-09, -1.3e-09, 1.7e-09,
+	2.1e-09, -3.7e-09, 4.3e-09]
+
+def generate_gcode(path, layers, moves_per_layer, seed=0):
+	"""Write a synthetic Slic3r style G-code file to path, with the given
+	number of layers and of extrusion moves per layer. Moves wander around
+	the bed with lengths of 0.5 to 12mm, so some are split and some not,
+	with a travel move every 10 moves. The same seed gives the same file."""
+	rand = random.Random(seed)
+	with open(path, 'w') as f:
+		f.write('; synthetic benchmark part: %d layers x %d moves\n' % (layers, moves_per_layer))
+		f.write('G21\nM83\nG28 X Y\nG28 Z\n; END RAFT\n')
+		(x, y) = (95.0, 115.0)
+		for layer in range(0, layers):
+			f.write('G0 Z%.1f F200.0 ; move Z\n' % (0.3 + 0.2*layer))
+			f.write('G10 ; retract\n')
+			f.write('G1 X%.1f Y%.1f F10800.0\n' % (x, y))
+			f.write('G11 ; unretract!\n')
+			for move in range(0, moves_per_layer):
+				length = rand.uniform(0.5, 12)
+				(dx, dy) = rand.choice([(1, 0), (0, 1), (-1, 0), (0, -1), (0.6, 0.8), (-0.8, 0.6)])
+				x = min(max(x + dx*length, 20), 170)
+				y = min(max(y + dy*length, 20), 210)
+				if move % 10 == 9:
+					f.write('G1 X%.3f Y%.3f F10800.0\n' % (x, y))
+				else:
+					f.write('G1 X%.3f Y%.3f E%.5f F1225.0\n' % (x, y, 0.05*length))
+		f.write('M104 S0 ; heater off\n')
+
+def peak_rss_mb():
+	"""Return this process' peak resident memory so far in MB, or None."""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak/(1024.0*1024) if sys.platform == 'darwin' else peak/1024.0 #bytes on OS X, KB elsewhere
+
+def benchmark_file(args):
+	"""Benchmark every stage on one G-code file, run REPEATS times each and
+	keeping the best time. Returns a dict of results."""
+	(path, repeats) = args
+	text = open(path).read()
+	lines = [l for l in text.split('\n') if l]
+	stages = collections.OrderedDict()
+
+	def run(name, func, setup=None):
+		"""Time func(setup()) (or func()), excluding setup, and record it."""
+		best = float('inf')
+		for i in range(0, repeats):
+			arg = setup() if setup else None
+			start = time.time()
+			result = func(arg) if setup else func()
+			best = min(best, time.time() - start)
+		stages[name] = {
+			'seconds': best,
+			'lines_per_second': len(lines)/best if best else None,
+			'cumulative_peak_rss_mb': peak_rss_mb(), #of the run so far, see above
+			}
+		return result
+
+	def parse_unsplit():
+		layer_lines = gcode.iter_layer_lines(lines)
+		preamble = gcode.make_preamble(next(layer_lines))
+		prev_final_pt = preamble.get_final_point() if preamble else gcode.Point(0,0,0)
+		layers = []
+		for layernum, curr_layer in enumerate(layer_lines, 1):
+			layers.append(gcode.Layer(prev_final_pt, curr_layer, split=False, layernum=layernum))
+			prev_final_pt = layers[-1].get_final_point()
+		return layers
+
+	def split(layers):
+		#same moves as Layer splits: the first line, and moves with an E
+		for layer in layers:
+			for i, line in enumerate(layer.lines):
+				if line.code in {'G0','G1'} and (i == 0 or 'E' in line.args):
+					line.split_move(gcode.SEG_LENGTH_SPLIT)
+
+	piecewise_compensator = compensate_z_uniform.load_layerwise_compensator(LOOKUP_TABLE_PATH)
+	compensator_3d = compensate_z_3d.Compensator3D(BENCHMARK_COEFFS)
+
+	run('tokenize', lambda: [gcode.tokenize(l) for l in lines])
+	unsplit_layers = run('parse', parse_unsplit)
+	run('split', lambda layers: split(layers), lambda: unsplit_layers)
+	unsplit_layers = None
+	g = run('parse_split', lambda: gcode.Gcode(filestring=text))
+	compact = run('parse_compact', lambda: gcode.Gcode(filestring=text, compact=True))
+	minimal = run('parse_minimal', lambda: gcode.Gcode(filestring=text, minimal=True))
+	run('split_adaptive', lambda layers: [layer.split_adaptive(compensator_3d,
+		compensate_z_3d.Z_CONTROL_RESOLUTION) for layer in layers[1:]], parse_unsplit)
+	run('compensate_uniform',
+		lambda layers: list(compensate_z_uniform.shift_layers(layers, piecewise_compensator)),
+		lambda: g.copy().layers)
+	run('compensate_3d', lambda h: h.z_compensate(compensator_3d), g.copy)
+	run('construct', lambda: g.construct())
+	run('construct_compact', lambda: compact.construct())
+	run('construct_modal', lambda: g.construct(modal=True))
+	run('compensate_minimal', lambda layers: '\n'.join(layer.construct() for layer in
+		compensate_z_uniform.shift_layers(layers, piecewise_compensator)),
+		lambda: [layer.copy() for layer in minimal.layers])
+
+	return {
+		'input': os.path.basename(path),
+		'lines': len(lines),
+		'bytes': len(text),
+		'layers': len(g.layers),
+		'stages': stages,
+		}
+
+def git_revision():
+	"""Return the current git commit of the repository, or None."""
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+			stderr=open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(results, baseline):
+	"""Print each stage's time relative to a baseline run of the same input."""
+	baseline_results = dict((result['input'], result) for result in baseline['results'])
+	for result in results:
+		if result['input'] not in baseline_results:
+			continue
+		print '%s vs %s:' % (result['input'], baseline.get('revision') or 'baseline')
+		for name, stage in result['stages'].items():
+			baseline_stage = baseline_results[result['input']]['stages'].get(name)
+			if baseline_stage:
+				print '  %-20s %.2fx time' % (name, stage['seconds']/baseline_stage['seconds'])
+
+def main():
+	parser = argparse.ArgumentParser(
+		description='Benchmark each stage of the compensation pipeline.')
+	parser.add_argument('gcode_paths', nargs='*', metavar='GCODE',
+		help='G-code files to benchmark (default: example_files/*.gcode, unless -s is given)')
+	parser.add_argument('-s', '--synthetic', action='append', default=[], metavar='LAYERSxMOVES',
+		help='also benchmark a synthetic part of this size, e.g. 200x100 (repeatable);'
+			' generated once into the temporary directory')
+	parser.add_argument('-r', '--repeats', type=int, default=1,
+		help='times to run each stage, the best time is kept (default: 1)')
+	parser.add_argument('-o', '--output', default='benchmark_results.json',
+		help='JSON file to write results to (default: benchmark_results.json)')
+	parser.add_argument('-c', '--compare', metavar='BASELINE',
+		help='JSON results of an earlier run to compare against')
+	args = parser.parse_args()
+
+	paths = list(args.gcode_paths)
+	if not paths and not args.synthetic:
+		paths = sorted(glob.glob(os.path.join(ROOT, 'example_files', '*.gcode')))
+	synthetic_dir = os.path.join(tempfile.gettempdir(), 'gcode_benchmarks')
+	for size in args.synthetic:
+		(layers, moves_per_layer) = [int(n) for n in size.lower().split('x')]
+		if not os.path.isdir(synthetic_dir):
+			os.makedirs(synthetic_dir)
+		path = os.path.join(synthetic_dir, 'synthetic_%dx%d.gcode' % (layers, moves_per_layer))
+		if not os.path.exists(path):
+			generate_gcode(path, layers, moves_per_layer)
+		paths.append(path)
+
+	results = []
+	for path in paths:
+		#a fresh process per input, so each has its own peak memory
+		pool = multiprocessing.Pool(1)
+		try:
+			result = pool.apply(benchmark_file, ((path, args.repeats),))
+		finally:
+			pool.close()
+			pool.join()
+		print '%s: %d lines, %d layers' % (result['input'], result['lines'], result['layers'])
+		for name, stage in result['stages'].items():
+			print '  %-20s %7.3fs %9d lines/s %8s MB peak so far' % (name, stage['seconds'],
+				stage['lines_per_second'] or 0, '%.1f' % stage['cumulative_peak_rss_mb']
+				if stage['cumulative_peak_rss_mb'] is not None else '-')
+		sys.stdout.flush()
+		results.append(result)
+
+	report = {
+		'revision': git_revision(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'repeats': args.repeats,
+		'results': results,
+		}
+	with open(args.output, 'w') as f:
+		json.dump(report, f, indent=2)
+	print 'Results written to %s' % args.output
+
+	if args.compare:
+		with open(args.compare) as f:
+			compare(results, json.load(f))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,80 @@
+"""
+Compare gcode.tokenize() against the regex based parser it replaced in
+Line.__init__, on the files in example_files/. Checks both produce the same
+result for every line, then reports lines tokenized per second.
+
+Usage: python benchmarks/tokenizer.py [gcode files...]
+"""
+
+import glob
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'libs', 'python-gcode'))
+
+import gcode
+
+#number of times to tokenize each file, best run is reported
+REPEATS = 3
+
+def tokenize_regex(line):
+	"""Line.__init__ parsing before gcode.tokenize(), for reference."""
+	if re.match(r'\s*;', line):
+		return line, None, None, line[line.index(';')+1:]
+	comment = None
+	lc = line.split(';', 1)
+	if len(lc) > 1:
+		line, comment = lc
+	args = line.split()
+	code = args[0]
+	parsed_args = {}
+	if code == 'M117' or code == 'M38' or code == '\\nM38':
+		parsed_args[None] = line.split(None, 1)[1]
+	else:
+		for arg in args[1:]:
+			if re.match('[A-Za-z]', arg[0]):
+				if arg[1:] is not None and arg[1:] != '':
+					parsed_args[arg[0]] = float(arg[1:])\
+					 if '.' in arg[1:]\
+					  else int(arg[1:])
+				else:
+					parsed_args[arg[0]] = None
+			else:
+				parsed_args[None] = arg
+	return line, code, parsed_args, comment
+
+def time_tokenizer(tokenizer, lines):
+	"""Return best wall time over REPEATS runs of tokenizer over lines."""
+	best = float('inf')
+	for i in range(0, REPEATS):
+		start = time.time()
+		for line in lines:
+			tokenizer(line)
+		best = min(best, time.time() - start)
+	return best
+
+def main(paths):
+	for path in paths:
+		lines = [l for l in open(path).read().split('\n') if l]
+
+		#sanity check: both tokenizers must agree, including int/float types
+		for line in lines:
+			expected = tokenize_regex(line)
+			actual = gcode.tokenize(line)
+			if expected != actual or (expected[2] and
+					[type(v) for v in expected[2].values()] !=
+					[type(v) for v in actual[2].values()]):
+				raise ValueError('Tokenizers disagree on line: %s' % line)
+
+		regex_time = time_tokenizer(tokenize_regex, lines)
+		fast_time = time_tokenizer(gcode.tokenize, lines)
+		print '%s: %d lines' % (os.path.basename(path), len(lines))
+		print '  regex:    %.3fs (%d lines/s)' % (regex_time, len(lines)/regex_time)
+		print '  tokenize: %.3fs (%d lines/s)' % (fast_time, len(lines)/fast_time)
+		print '  speedup:  %.1fx' % (regex_time/fast_time)
+
+if __name__ == "__main__":
+	main(sys.argv[1:] or sorted(glob.glob(os.path.join(ROOT, 'example_files', '*.gcode'))))
@@ -0,0 +1,166 @@
+"""
+Batch Z compensation of many G-code files against many printers' error models.
+
+Every model is loaded once, and each G-code file is parsed once per worker
+process; the (file, printer) jobs are then fanned out across a pool of
+workers. Each job writes its output to
+  <output directory>/<gcode file name>_<printer>_compensated.gcode (uniform)
+  <output directory>/<gcode file name>_<printer>_3d_compensated.gcode (3D)
+and reports its throughput. Compressed G-code files (.gcode.gz, .gcode.xz,
+.gcode.zst) are read and written compressed, see gcode.open_gcode().
+
+Example:
+  python compensate_batch.py -u printer1=model_fitting/printer1_lookup.csv \
+    -m printer2=printer2_coefficients.csv -o compensated/ part1.gcode part2.gcode
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs', 'python-gcode'))
+
+import gcode
+import compensate_z_uniform
+import compensate_z_3d
+
+#models by printer name, loaded once per worker by init_worker()
+printer_models = {}
+
+#most recently parsed gcode file in this worker for each parse mode (minimal
+#for uniform models, compact for 3D ones), as (path, Gcode, number of lines)
+parsed_gcode = {True: (None, None, 0), False: (None, None, 0)}
+
+def compensate_batch(gcode_paths, uniform_models={}, models_3d={}, output_dir=None, processes=None):
+	"""
+	Compensate every G-code file against every printer model, in parallel.
+	uniform_models and models_3d map printer names to lookup table and model
+	coefficients CSV paths respectively. Outputs go to output_dir (defaults to
+	alongside each G-code file). Returns a list of per job reports, see run_job().
+	"""
+	# Validate arguments
+	if not type(gcode_paths) is list:
+		raise TypeError('Unexpected data type for argument gcode_paths. Expecting list.')
+	for gcode_path in gcode_paths:
+		if not gcode.is_gcode_filename(gcode_path):
+			raise ValueError('Unexpected file type for gcode file specified. Expecting .gcode file, optionally compressed.')
+	for model_path in uniform_models.values() + models_3d.values():
+		if not model_path.endswith('.csv'):
+			raise ValueError('Unexpected file type for model specified. Expecting .csv file.')
+	if set(uniform_models) & set(models_3d):
+		raise ValueError('Printer names must be unique across uniform and 3D models.')
+
+	# Load every model once
+	models = {}
+	for printer, lookup_table_path in uniform_models.items():
+		models[printer] = ('uniform', compensate_z_uniform.load_layerwise_compensator(lookup_table_path))
+	for printer, model_coefficients_path in models_3d.items():
+		models[printer] = ('3d', compensate_z_3d.load_compensator_3d(model_coefficients_path))
+
+	# Fan out (file, printer) jobs, keeping each file's jobs together so it is only parsed once
+	jobs = [(gcode_path, printer, output_dir)
+			for gcode_path in gcode_paths for printer in sorted(models)]
+	pool = multiprocessing.Pool(processes, init_worker, (models,))
+	try:
+		reports = []
+		for report in pool.imap(run_job, jobs, max(len(models), 1)):
+			print format_report(report)
+			sys.stdout.flush()
+			reports.append(report)
+	finally:
+		pool.close()
+		pool.join()
+	return reports
+
+def init_worker(models):
+	"""Pool initializer: keep the loaded models for every job run by this worker."""
+	printer_models.update(models)
+
+def output_path(gcode_path, printer, kind, output_dir=None):
+	"""Return the output path for gcode_path compensated with printer's model."""
+	(directory, filename) = os.path.split(gcode_path)
+	tag = '_3d_compensated' if kind == '3d' else '_compensated'
+	return os.path.join(output_dir if output_dir else directory,
+			gcode.output_filename(filename, '_' + printer + tag))
+
+def run_job(job):
+	"""
+	Compensate one G-code file with one printer's model and write it out.
+	Returns a dict reporting the file, printer, output path, wall time, lines
+	read and bytes read and written.
+	"""
+	(gcode_path, printer, output_dir) = job
+	(kind, compensator) = printer_models[printer]
+	start_time = time.time()
+
+	# Parse each file once per mode, compensating a copy for each printer
+	# (uniform models only shift whole layers, so parse minimally for them,
+	# as compensate_z_uniform does)
+	minimal = kind == 'uniform'
+	if parsed_gcode[minimal][0] != gcode_path:
+		lines_in = sum(1 for l in gcode.read_lines(gcode_path))
+		parsed_gcode[minimal] = (gcode_path, gcode.Gcode(gcode_path, compact=not minimal,
+				minimal=minimal), lines_in)
+	(parsed, lines_in) = parsed_gcode[minimal][1:]
+	g = parsed.copy()
+
+	if kind == 'uniform':
+		g.layers = list(compensate_z_uniform.shift_layers(g.layers, compensator))
+	else:
+		g.z_compensate(compensator)
+
+	outfile = output_path(gcode_path, printer, kind, output_dir)
+	g.construct(outfile)
+
+	return {
+		'gcode_path': gcode_path,
+		'printer': printer,
+		'output_path': outfile,
+		'seconds': time.time() - start_time,
+		'lines_in': lines_in,
+		'bytes_in': os.path.getsize(gcode_path),
+		'bytes_out': os.path.getsize(outfile),
+		}
+
+def format_report(report):
+	"""Return a one line summary of a job report."""
+	return '%s [%s] -> %s: %.2fs, %d lines in (%d lines/s), %.1f MB out (%.1f MB/s)' % (
+		report['gcode_path'], report['printer'], report['output_path'], report['seconds'],
+		report['lines_in'], report['lines_in']/report['seconds'],
+		report['bytes_out']/1e6, report['bytes_out']/report['seconds']/1e6)
+
+def parse_printer_models(specs):
+	"""Parse a list of NAME=PATH command line arguments into a dict."""
+	models = {}
+	for spec in specs:
+		if '=' not in spec:
+			raise ValueError('Expecting printer model as NAME=PATH, got %s.' % spec)
+		(printer, path) = spec.split('=', 1)
+		models[printer] = path
+	return models
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description='Compensate many G-code files against many printers\' error models.')
+	parser.add_argument('gcode_paths', nargs='+', metavar='GCODE',
+		help='G-code files to compensate')
+	parser.add_argument('-u', '--uniform', action='append', default=[], metavar='NAME=CSV',
+		help='printer name and piecewise compensation lookup table (repeatable)')
+	parser.add_argument('-m', '--model-3d', action='append', default=[], metavar='NAME=CSV',
+		help='printer name and 3D error model coefficients (repeatable)')
+	parser.add_argument('-o', '--output-dir', default=None,
+		help='directory to write outputs to (default: alongside each input)')
+	parser.add_argument('-j', '--processes', type=int, default=None,
+		help='number of worker processes (default: number of CPUs)')
+	args = parser.parse_args()
+
+	start_time = time.time()
+	reports = compensate_batch(args.gcode_paths,
+		parse_printer_models(args.uniform),
+		parse_printer_models(args.model_3d),
+		args.output_dir,
+		args.processes)
+	elapsed = time.time() - start_time
+	print '%d jobs in %.2fs (%.2f jobs/s, %d lines/s)' % (len(reports), elapsed,
+		len(reports)/elapsed, sum(report['lines_in'] for report in reports)/elapsed)
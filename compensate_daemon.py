@@ -0,0 +1,285 @@
+"""
+Long-running Z compensation service, for callers such as slicer
+post-processing hooks that would otherwise pay interpreter startup, imports
+and model loading on every job. Models are loaded once per worker process
+and kept, being reloaded only when their file's modification time changes.
+Jobs run concurrently across a pool of worker processes.
+
+Jobs are sent as one JSON object per line, over a Unix socket:
+  python compensate_daemon.py -S /tmp/compensate.sock
+  echo '{"id": 1, "kind": "3d", "model": "coefficients.csv", "gcode": "part.gcode"}' \
+    | nc -U /tmp/compensate.sock
+or on stdin, with responses on stdout:
+  python compensate_daemon.py < jobs.jsonl
+
+A job is an object with:
+  kind     "uniform", "3d" or "combined"
+  model    lookup table or model coefficients CSV path (uniform and 3d), or
+  models   list of ["uniform" or "3d", CSV path] pairs (combined, in order)
+  gcode    G-code file to compensate (may be compressed, see gcode.open_gcode())
+  output   optional output path (default: as compensate_z_uniform,
+           compensate_z_3d or compensate_z_combined name it)
+  stream, modal, minimal (uniform), adaptive (3d)
+           optional options, as for those functions
+  id       optional, echoed back in the response
+One response line is written per job as it completes (not necessarily in
+the order sent): {"id": ..., "ok": true, "output": ..., "seconds": ...}, or
+{"id": ..., "ok": false, "error": ...}. {"command": "ping"} is answered
+with the daemon's process id.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import stat
+import SocketServer
+import sys
+import threading
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs', 'python-gcode'))
+
+import gcode
+import compensate_z_uniform
+import compensate_z_3d
+import compensate_z_combined
+
+LOADERS = {
+	'uniform': compensate_z_uniform.load_layerwise_compensator,
+	'3d': compensate_z_3d.load_compensator_3d,
+	}
+OUTPUT_TAGS = {
+	'uniform': '_compensated',
+	'3d': '_3d_compensated',
+	'combined': '_combined_compensated',
+	}
+JOB_OPTIONS = {
+	'uniform': ('stream', 'modal', 'minimal'),
+	'3d': ('stream', 'modal', 'adaptive'),
+	'combined': ('stream', 'modal'),
+	}
+JOB_DEFAULTS = {
+	('uniform', 'minimal'): True, #as compensate_z_uniform chooses it
+	}
+
+class ModelCache:
+	def __init__(self):
+		"""Compensators by (kind, path), each kept with the modification time
+		of the file it was loaded from."""
+		self.models = {}
+
+	def get(self, kind, path):
+		"""Return the compensator for the given model file, loading it if it
+		is not loaded yet or the file changed since."""
+		mtime = os.path.getmtime(path)
+		key = (kind, os.path.abspath(path))
+		if key not in self.models or self.models[key][0] != mtime:
+			self.models[key] = (mtime, LOADERS[kind](path))
+		return self.models[key][1]
+
+#models loaded by this worker process, see run_job()
+model_cache = ModelCache()
+
+def parse_job(request):
+	"""Validate a job request (a dict decoded from JSON), returning it as a
+	job tuple of (kind, list of (kind, model path), gcode path, output path,
+	dict of options) for run_job()."""
+	if not type(request) is dict:
+		raise TypeError('Unexpected data type for job. Expecting JSON object.')
+	kind = request.get('kind')
+	if not kind in OUTPUT_TAGS:
+		raise ValueError("Unexpected job kind. Expecting 'uniform', '3d' or 'combined'.")
+	if kind == 'combined':
+		models = request.get('models')
+		if not (type(models) is list and models and all(type(model) is list and len(model) == 2
+				and model[0] in LOADERS for model in models)):
+			raise ValueError("Unexpected models. Expecting list of ['uniform' or '3d', path] pairs.")
+		models = [(model_kind, str(path)) for model_kind, path in models]
+	else:
+		if not isinstance(request.get('model'), basestring):
+			raise TypeError('Unexpected data type for model. Expecting str.')
+		models = [(kind, str(request['model']))]
+	for model_kind, path in models:
+		if not path.endswith('.csv'):
+			raise ValueError('Unexpected file type for model specified. Expecting .csv file.')
+	gcode_path = request.get('gcode')
+	if not isinstance(gcode_path, basestring):
+		raise TypeError('Unexpected data type for gcode. Expecting str.')
+	elif not gcode.is_gcode_filename(gcode_path):
+		raise ValueError('Unexpected file type for gcode file specified. Expecting .gcode file, optionally compressed.')
+	gcode_path = str(gcode_path)
+	output_path = request.get('output') or gcode.output_filename(gcode_path, OUTPUT_TAGS[kind])
+	if not isinstance(output_path, basestring):
+		raise TypeError('Unexpected data type for output. Expecting str.')
+	options = {}
+	for option in JOB_OPTIONS[kind]:
+		options[option] = request.get(option, JOB_DEFAULTS.get((kind, option), False))
+		if not type(options[option]) is bool:
+			raise TypeError('Unexpected data type for %s. Expecting bool.' % option)
+	return (kind, models, gcode_path, str(output_path), options)
+
+def run_job(job):
+	"""
+	Compensate one G-code file in a worker process, with its models from
+	model_cache. Writes the same output as the corresponding compensate_z_*
+	function. Returns a response dict, reporting errors rather than raising
+	them.
+	"""
+	(kind, models, gcode_path, output_path, options) = job
+	start_time = time.time()
+	try:
+		compensators = [model_cache.get(model_kind, path) for model_kind, path in models]
+		stream = options['stream']
+		if kind == 'uniform':
+			minimal = options['minimal']
+			g = gcode.GcodeStream(gcode_path, minimal=minimal) if stream\
+				else gcode.Gcode(gcode_path, minimal=minimal)
+			g.layers = compensate_z_uniform.shift_layers(g.layers, compensators[0])
+		elif kind == '3d':
+			split = not options['adaptive']
+			g = gcode.GcodeStream(gcode_path, split=split) if stream\
+				else gcode.Gcode(gcode_path, split=split)
+			if not split:
+				g.split_adaptive(compensators[0], compensate_z_3d.Z_CONTROL_RESOLUTION)
+			g.z_compensate(compensators[0])
+		else:
+			#chains keep per-layer state, so each job gets its own
+			chain = compensate_z_combined.CompensatorChain(compensators)
+			minimal = not chain.point_compensators
+			g = gcode.GcodeStream(gcode_path, minimal=minimal) if stream\
+				else gcode.Gcode(gcode_path, minimal=minimal)
+			g.layers = compensate_z_combined.compensate_layers(g.layers, chain)
+		if not stream:
+			g.layers = list(g.layers)
+		g.construct(output_path, options['modal'])
+	except Exception as e:
+		return {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+	return {'ok': True, 'output': output_path, 'seconds': time.time() - start_time}
+
+class CompensationDaemon:
+	def __init__(self, processes=None):
+		"""Pool of worker processes (processes defaults to the number of CPUs)
+		running jobs submitted from any number of connections."""
+		self.pool = multiprocessing.Pool(processes, ignore_signals)
+		self.jobs_done = 0
+		self.lock = threading.Lock()
+
+	def close(self):
+		"""Finish any running jobs and stop the workers."""
+		self.pool.close()
+		self.pool.join()
+
+	def submit(self, line, callback):
+		"""Handle one request line, calling callback with the response dict
+		once it is ready (immediately for invalid requests and commands)."""
+		try:
+			request = json.loads(line)
+		except ValueError:
+			callback({'ok': False, 'error': 'ValueError: Unexpected request. Expecting JSON.'})
+			return
+		request_id = request.get('id') if type(request) is dict else None
+		def respond(response):
+			response['id'] = request_id
+			with self.lock:
+				self.jobs_done += 'output' in response
+			callback(response)
+
+		if type(request) is dict and 'command' in request:
+			if request['command'] == 'ping':
+				respond({'ok': True, 'pid': os.getpid(), 'jobs_done': self.jobs_done})
+			else:
+				respond({'ok': False, 'error': 'ValueError: Unexpected command.'})
+			return
+		try:
+			job = parse_job(request)
+		except (TypeError, ValueError) as e:
+			respond({'ok': False, 'error': '%s: %s' % (type(e).__name__, e)})
+			return
+		self.pool.apply_async(run_job, (job,), callback=respond)
+
+	def serve(self, rfile, wfile):
+		"""Read request lines from rfile until it ends, writing a response
+		line to wfile for each as it completes. Returns once every job read
+		has been responded to. Responses to a client that has gone away
+		(wfile raising an error) are dropped: write_response() runs on the
+		pool's result handler thread, which an exception would kill, leaving
+		every later job without a response and the pool unable to close."""
+		state = {'pending': 0, 'gone': False}
+		done = threading.Condition()
+		def write_response(response):
+			with done:
+				if not state['gone']:
+					try:
+						wfile.write(json.dumps(response) + '\n')
+						wfile.flush()
+					except EnvironmentError: #EPIPE, ECONNRESET...
+						state['gone'] = True
+				state['pending'] -= 1
+				done.notify()
+
+		for line in iter(rfile.readline, ''):
+			if not line.strip():
+				continue
+			with done:
+				state['pending'] += 1
+			self.submit(line, write_response)
+		with done:
+			while state['pending']:
+				done.wait(1) #a timeout keeps the wait interruptible
+
+def ignore_signals():
+	"""Pool initializer: leave interrupts and termination (often sent to the
+	whole process group) to the daemon, which finishes running jobs before
+	exiting. A worker killed while waiting for a job would leave the pool
+	unable to shut down."""
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+class JobHandler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		self.server.daemon.serve(self.rfile, self.wfile)
+
+	def finish(self):
+		try:
+			SocketServer.StreamRequestHandler.finish(self)
+		except EnvironmentError:
+			pass #client went away, leaving unsent responses (see serve())
+
+class JobServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, socket_path, daemon):
+		"""Unix socket server handing each connection's jobs to daemon."""
+		if os.path.exists(socket_path):
+			if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+				raise ValueError('Unexpected file at socket path. Expecting a socket or nothing.')
+			os.remove(socket_path) #left behind by a previous daemon
+		SocketServer.UnixStreamServer.__init__(self, socket_path, JobHandler)
+		self.daemon = daemon
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description='Run Z compensation jobs with warm models, read from a Unix socket or stdin.')
+	parser.add_argument('-S', '--socket', default=None,
+		help='Unix socket to listen on (default: read jobs from stdin, respond on stdout)')
+	parser.add_argument('-j', '--processes', type=int, default=None,
+		help='number of worker processes (default: number of CPUs)')
+	args = parser.parse_args()
+
+	daemon = CompensationDaemon(args.processes)
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		if args.socket:
+			server = JobServer(args.socket, daemon)
+			try:
+				server.serve_forever()
+			except KeyboardInterrupt:
+				pass
+			finally:
+				server.server_close()
+				os.remove(args.socket)
+		else:
+			daemon.serve(sys.stdin, sys.stdout)
+	finally:
+		daemon.close()
@@ -0,0 +1,453 @@
+"""
+Compensate a G-code file on the fly and send it straight to a printer over a
+serial port, instead of writing the compensated file out first. Printing
+starts as soon as the first layer is compensated; layers are compensated a
+few ahead of the printer (see gcode.Gcode.iter_lines()), so memory use stays
+flat however long the file.
+
+Lines are sent with line numbers and checksums, and resent when the printer
+asks for them. Flow control counts the printer's "ok"s: at most WINDOW lines
+(and RX_BUFFER bytes) are sent ahead of them, one by default. Ports are
+opened with pyserial if it is installed, otherwise through termios (Linux,
+OS X). --fake sends to a simulated printer on a pseudo-terminal instead,
+which checks the protocol and can write out the lines it "executes".
+
+Example (same models as compensate_z_combined):
+  python compensate_send.py -u model_fitting/piecewise_compensation_lookup.csv \
+    -m coefficients.csv --port /dev/ttyUSB0 part.gcode
+"""
+
+import argparse
+import collections
+import os
+import re
+import select
+import sys
+import threading
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs', 'python-gcode'))
+try:
+	import serial
+except ImportError: #fall back to termios
+	serial = None
+try:
+	import pty
+	import termios
+	import tty
+except ImportError: #not available on Windows, pyserial is needed there
+	termios = None
+
+import gcode
+import compensate_z_combined
+
+HISTORY_LINES = 1024 #sent lines kept for resending
+RESEND = re.compile(r'(?:Resend|rs)[:\s]\s*N?(\d+)', re.IGNORECASE) #printer asking to resend from a line
+RESEND_ERRORS = ('line number', 'checksum', 'no line number') #errors followed by a resend request
+
+def compensate_send(models, gcode_path, port, baudrate=115200, lookahead=2, window=1, rx_buffer=127, modal=False, timeout=None):
+	"""
+	Compensate gcode_path with models (as for compensate_z_combined()) and
+	send it to the printer on port (a serial device or pseudo-terminal path)
+	as it is compensated, constructing up to lookahead layers ahead of the
+	printer. window, rx_buffer and timeout are as for PrinterSender, modal
+	as for gcode.Gcode.construct(). Returns PrinterSender.send()'s report.
+	"""
+	# Validate arguments
+	compensate_z_combined.check_models(models)
+	if not type(gcode_path) is str:
+		raise TypeError('Unexpected data type for argument gcode_path. Expecting str.')
+	elif not gcode.is_gcode_filename(gcode_path):
+		raise ValueError('Unexpected file type for gcode file specified. Expecting .gcode file, optionally compressed.')
+	elif not type(lookahead) is int:
+		raise TypeError('Unexpected data type for argument lookahead. Expecting int.')
+	elif lookahead < 1:
+		raise ValueError('Unexpected value for argument lookahead. Expecting at least 1 layer.')
+	elif not type(modal) is bool:
+		raise TypeError('Unexpected data type for argument modal. Expecting bool.')
+
+	g = compensate_z_combined.compensated_gcode(models, gcode_path, stream=True)
+	lines = g.iter_lines(lookahead, modal)
+	link = SerialLink(port, baudrate)
+	try:
+		sender = PrinterSender(link, window, rx_buffer, timeout)
+		sender.connect()
+		return sender.send(lines)
+	finally:
+		lines.close()
+		link.close()
+
+def checksum(line):
+	"""Return the RepRap checksum of a line: the XOR of all its characters."""
+	result = 0
+	for c in line:
+		result ^= ord(c)
+	return result
+
+class SerialLink:
+	def __init__(self, port, baudrate=115200):
+		"""Line oriented connection to a printer on port, a serial device or
+		pseudo-terminal path (or an open file descriptor, used as it is)."""
+		self.buffer = ''
+		self.serial = None
+		self.fd = None
+		if type(port) is int:
+			self.fd = port
+		elif serial is not None:
+			self.serial = serial.Serial(port, baudrate)
+		elif termios is not None:
+			speed = getattr(termios, 'B%d' % baudrate, None)
+			if speed is None:
+				raise ValueError('Unexpected baud rate %d.' % baudrate)
+			self.fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+			tty.setraw(self.fd)
+			attributes = termios.tcgetattr(self.fd)
+			attributes[4] = attributes[5] = speed #input and output speed
+			termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+		else:
+			raise ValueError('Unexpected platform. Expecting pyserial to be installed.')
+
+	def __repr__(self):
+		return '<SerialLink %s>' % (self.serial.port if self.serial else self.fd)
+
+	def close(self):
+		if self.serial:
+			self.serial.close()
+		elif self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+	def write(self, data):
+		if self.serial:
+			self.serial.write(data)
+			return
+		while data:
+			data = data[os.write(self.fd, data):]
+
+	def read(self, timeout=None):
+		"""Return the bytes available, waiting up to timeout seconds (None
+		to wait indefinitely) for some. Returns '' on timeout."""
+		if self.serial:
+			self.serial.timeout = timeout
+			return self.serial.read(max(1, self.serial.in_waiting))
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return ''
+		try:
+			data = os.read(self.fd, 4096)
+		except OSError: #a pseudo-terminal whose other end closed
+			data = ''
+		if not data:
+			raise IOError('Printer disconnected.')
+		return data
+
+	def readline(self, timeout=None):
+		"""Return the next line received, without its line ending, or None
+		if none is completed within timeout seconds."""
+		deadline = time.time() + timeout if timeout is not None else None
+		while not '\n' in self.buffer:
+			remaining = max(0, deadline - time.time()) if deadline is not None else None
+			data = self.read(remaining)
+			if not data and deadline is not None and time.time() >= deadline:
+				return None
+			self.buffer += data
+		(l, self.buffer) = self.buffer.split('\n', 1)
+		return l.rstrip('\r')
+
+class PrinterSender:
+	def __init__(self, link, window=1, rx_buffer=127, timeout=None):
+		"""
+		Sends gcode lines over a SerialLink with RepRap style flow control:
+		every line is numbered and checksummed and answered by the printer
+		with an "ok", or a request to resend from some line on. Up to window
+		lines, of at most rx_buffer bytes in all (the firmware's serial
+		receive buffer), are sent ahead of their "ok"s; one at a time by
+		default, which suits any firmware. Raises IOError if the printer
+		reports an error, or is silent for timeout seconds (None to wait
+		indefinitely; busy and temperature reports count as responses).
+		"""
+		if not (type(window) is int and window >= 1):
+			raise ValueError('Unexpected window. Expecting at least 1 line.')
+		elif not (type(rx_buffer) is int and rx_buffer > 0):
+			raise ValueError('Unexpected rx_buffer. Expecting a number of bytes.')
+		self.link = link
+		self.window = window
+		self.rx_buffer = rx_buffer
+		self.timeout = timeout
+		self.lineno = 0 #number of the last line numbered
+		self.history = collections.deque(maxlen=HISTORY_LINES) #(number, line as sent)
+		self.pending = collections.deque() #lines as sent, to send next
+		self.outstanding = collections.deque() #bytes of each line sent and not acknowledged yet
+		self.stale = 0 #outstanding lines sent before the last resend request
+		self.resent_from = None
+		self.last_response = time.time()
+		self.resends = 0
+		self.printer_wait = 0.0 #seconds spent waiting for the printer
+		self.gcode_wait = 0.0 #seconds spent waiting for lines to send
+
+	def __repr__(self):
+		return '<PrinterSender at line %d>' % self.lineno
+
+	def connect(self, retry_interval=2.0):
+		"""Reset the printer's line numbering with M110, resending it every
+		retry_interval seconds until it is acknowledged (a printer reset by
+		opening the port ignores what it receives while booting)."""
+		deadline = time.time() + self.timeout if self.timeout is not None else None
+		unanswered = 0
+		while True:
+			self.link.write('M110 N0\n')
+			unanswered += 1
+			retry = time.time() + retry_interval
+			response = ''
+			while response is not None and not response.startswith('ok'):
+				response = self.link.readline(max(0, retry - time.time()))
+			if response is not None:
+				unanswered -= 1
+				break
+			if deadline is not None and time.time() > deadline:
+				raise IOError('No response from printer for %ds.' % self.timeout)
+		#earlier M110s may have been received after all, so their "ok"s must not be taken for lines'
+		while unanswered and response is not None:
+			response = self.link.readline(retry_interval)
+			if response is not None and response.startswith('ok'):
+				unanswered -= 1
+		self.lineno = 0
+		self.last_response = time.time()
+
+	def send(self, lines):
+		"""
+		Send every line of an iterable of gcode lines, as they are taken
+		from it, and wait for the printer to acknowledge the last. Comments
+		and empty lines are not sent. Returns a report dict of the lines
+		sent, lines resent, and seconds taken, spent waiting for the printer
+		and spent waiting for lines.
+		"""
+		start_time = time.time()
+		lines = iter(lines)
+		exhausted = False
+		while True:
+			if not self.pending and not exhausted:
+				wait = time.time()
+				l = next(lines, None)
+				self.gcode_wait += time.time() - wait
+				if l is None:
+					exhausted = True
+				else:
+					l = l.split(';', 1)[0].strip()
+					if not l:
+						continue
+					self.lineno += 1
+					l = 'N%d %s' % (self.lineno, l)
+					l = '%s*%d\n' % (l, checksum(l))
+					self.history.append((self.lineno, l))
+					self.pending.append(l)
+			if self.pending and self.has_room(len(self.pending[0])):
+				l = self.pending.popleft()
+				self.link.write(l)
+				self.outstanding.append(len(l))
+			elif exhausted and not self.pending and not self.outstanding:
+				break
+			else:
+				wait = time.time()
+				self.handle(self.link.readline(1.0))
+				self.printer_wait += time.time() - wait
+		return {
+			'lines': self.lineno,
+			'resends': self.resends,
+			'seconds': time.time() - start_time,
+			'printer_wait': self.printer_wait,
+			'gcode_wait': self.gcode_wait,
+			}
+
+	def has_room(self, size):
+		"""Return whether a line of size bytes can be sent without waiting."""
+		if not self.outstanding:
+			return True
+		return len(self.outstanding) < self.window and \
+			sum(self.outstanding) + size <= self.rx_buffer
+
+	def handle(self, response):
+		"""Act on one line received from the printer (None if none was)."""
+		if response is None:
+			if self.timeout is not None and time.time() - self.last_response > self.timeout:
+				raise IOError('No response from printer for %ds.' % self.timeout)
+			return
+		self.last_response = time.time()
+		resend = RESEND.match(response)
+		if response.startswith('ok'):
+			if self.outstanding:
+				self.outstanding.popleft()
+			if self.stale:
+				self.stale -= 1
+		elif resend:
+			self.resend(int(resend.group(1)))
+		elif response.startswith('Error:') or response.startswith('!!'):
+			if not any(error in response.lower() for error in RESEND_ERRORS):
+				raise IOError('Printer error: %s' % response)
+
+	def resend(self, lineno):
+		"""Send the lines from lineno on again. Lines sent before an earlier
+		request to resend from the same line are rejected by the printer
+		too, and their requests are ignored."""
+		if self.stale and lineno == self.resent_from:
+			return
+		if not self.history or lineno < self.history[0][0] or lineno > self.lineno:
+			raise IOError('Unexpected request to resend line %d.' % lineno)
+		self.resends += 1
+		self.stale = len(self.outstanding)
+		self.resent_from = lineno
+		self.pending = collections.deque(l for number, l in self.history if number >= lineno)
+
+class FakePrinter:
+	def __init__(self, fd, lines_per_second=None, rx_buffer=127, error_every=None, output=None):
+		"""
+		Simulated printer for testing senders, talking over fd (the master
+		end of a pseudo-terminal). It checks line numbers and checksums like
+		Marlin, asking for a resend when they are wrong, and executes one
+		line at a time at up to lines_per_second (unlimited if None),
+		answering "ok" once each is executed. error_every corrupts every
+		error_every-th line received, to exercise resends. Lines executed
+		are written to the file object output, if given. Counts overflows
+		of its rx_buffer bytes receive buffer.
+		"""
+		self.link = SerialLink(fd)
+		self.lines_per_second = lines_per_second
+		self.rx_buffer = rx_buffer
+		self.error_every = error_every
+		self.output = output
+		self.last_lineno = 0
+		self.received = 0
+		self.executed = 0
+		self.overflows = 0
+		self.unacknowledged = 0 #bytes received and not answered yet
+		self.slave = None #the other end, see open_fake_printer()
+		self.thread = threading.Thread(target=self.run, name='fake printer')
+		self.thread.daemon = True
+
+	def __repr__(self):
+		return '<FakePrinter at line %d>' % self.last_lineno
+
+	def start(self):
+		self.link.write('start\n')
+		self.thread.start()
+
+	def close(self):
+		"""Close both ends of the pseudo-terminal, once the sender is done."""
+		if self.slave is not None:
+			os.close(self.slave)
+			self.slave = None
+		self.thread.join(1.0)
+		self.link.close()
+
+	def run(self):
+		try:
+			while True:
+				data = self.link.read()
+				self.unacknowledged += len(data)
+				if self.unacknowledged > self.rx_buffer:
+					self.overflows += 1
+				self.link.buffer += data
+				while '\n' in self.link.buffer:
+					(l, self.link.buffer) = self.link.buffer.split('\n', 1)
+					self.receive(l)
+					self.unacknowledged -= len(l) + 1
+		except (IOError, OSError): #the sender closed its end
+			pass
+
+	def receive(self, l):
+		"""Check and execute one line received, and answer it."""
+		self.received += 1
+		if self.error_every and self.received % self.error_every == 0:
+			l = l.replace('1', '7', 1) #line noise
+		if l.startswith('M110'):
+			self.last_lineno = int(l.split('N')[1]) if 'N' in l else 0
+			self.link.write('ok\n')
+			return
+		match = re.match(r'N(\d+) (.*)\*(\d+)$', l.rstrip('\r'))
+		if not match or checksum(l[0:l.rindex('*')]) != int(match.group(3)):
+			self.link.write('Error:checksum mismatch, Last Line: %d\nResend: %d\nok\n' % (
+					self.last_lineno, self.last_lineno + 1))
+			return
+		lineno = int(match.group(1))
+		if lineno != self.last_lineno + 1:
+			self.link.write('Error:Line Number is not Last Line Number+1, Last Line: %d\nResend: %d\nok\n' % (
+					self.last_lineno, self.last_lineno + 1))
+			return
+		self.last_lineno = lineno
+		if self.lines_per_second:
+			time.sleep(1.0/self.lines_per_second)
+		if self.output:
+			self.output.write(match.group(2) + '\n')
+		self.executed += 1
+		self.link.write('ok\n')
+
+def open_fake_printer(**kwargs):
+	"""Start a FakePrinter (kwargs are passed on to it) on a new
+	pseudo-terminal, returning it and the path to send to."""
+	if termios is None:
+		raise ValueError('Unexpected platform. Expecting pseudo-terminals.')
+	(master, slave) = pty.openpty()
+	tty.setraw(master)
+	tty.setraw(slave)
+	printer = FakePrinter(master, **kwargs)
+	printer.slave = slave #held open until close(), the master end reads nothing but errors without it
+	printer.start()
+	return printer, os.ttyname(slave)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description='Compensate a G-code file on the fly and send it to a printer.')
+	parser.add_argument('gcode_path', metavar='GCODE',
+		help='G-code file to compensate and print')
+	parser.add_argument('-u', '--uniform', dest='models', action='append', default=[],
+		type=lambda path: ('uniform', path), metavar='CSV',
+		help='piecewise compensation lookup table (repeatable, applied in the order given)')
+	parser.add_argument('-m', '--model-3d', dest='models', action='append', default=[],
+		type=lambda path: ('3d', path), metavar='CSV',
+		help='3D error model coefficients (repeatable, applied in the order given)')
+	parser.add_argument('--port', default=None,
+		help='serial port (or pseudo-terminal) of the printer')
+	parser.add_argument('-b', '--baudrate', type=int, default=115200,
+		help='serial baud rate (default: 115200)')
+	parser.add_argument('-l', '--lookahead', type=int, default=2,
+		help='layers compensated ahead of the printer (default: 2)')
+	parser.add_argument('-w', '--window', type=int, default=1,
+		help='lines sent ahead of the printer\'s acknowledgements (default: 1)')
+	parser.add_argument('-r', '--rx-buffer', type=int, default=127,
+		help='bytes the printer\'s serial receive buffer holds (default: 127)')
+	parser.add_argument('-t', '--timeout', type=float, default=None,
+		help='give up when the printer is silent this many seconds (default: never)')
+	parser.add_argument('-M', '--modal', action='store_true',
+		help='drop coordinates, feedrates and comments that change nothing')
+	parser.add_argument('--fake', action='store_true',
+		help='send to a simulated printer on a pseudo-terminal instead of --port')
+	parser.add_argument('--fake-rate', type=float, default=None, metavar='LINES_PER_SECOND',
+		help='lines per second the simulated printer executes (default: unlimited)')
+	parser.add_argument('--fake-errors', type=int, default=None, metavar='N',
+		help='corrupt every Nth line the simulated printer receives')
+	parser.add_argument('--fake-output', default=None, metavar='GCODE',
+		help='file to write the lines the simulated printer executes to')
+	args = parser.parse_args()
+
+	printer = None
+	port = args.port
+	if args.fake:
+		output = open(args.fake_output, 'w') if args.fake_output else None
+		(printer, port) = open_fake_printer(lines_per_second=args.fake_rate,
+			rx_buffer=args.rx_buffer, error_every=args.fake_errors, output=output)
+	elif not port:
+		parser.error('either --port or --fake is required')
+
+	try:
+		report = compensate_send(args.models, args.gcode_path, port, args.baudrate, args.lookahead,
+			args.window, args.rx_buffer, args.modal, args.timeout)
+	finally:
+		if printer:
+			printer.close()
+			if printer.output:
+				printer.output.close()
+	print '%d lines sent in %.2fs (%d lines/s), %d resends; waited %.2fs on the printer, %.2fs on compensation' % (
+		report['lines'], report['seconds'],
+		report['lines']/report['seconds'] if report['seconds'] else 0, report['resends'],
+		report['printer_wait'], report['gcode_wait'])
+	if printer:
+		print 'Fake printer: %d lines executed, %d receive buffer overflows' % (
+			printer.executed, printer.overflows)
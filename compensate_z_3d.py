@@ -1,6 +1,11 @@
+import bisect
+import collections
 import csv
+import math
+import os
 import re
 import sys
+import numpy as np
 sys.path.append('libs\\python-gcode\\')
 
 import gcode
@@ -8,8 +13,14 @@ reload(gcode)
 
 #define global parameters
 Z_CONTROL_RESOLUTION = 0.0105833 #mm per full step
+BUILD_VOLUME = ((-5.0, 195.0), (-30.0, 210.0), (0.0, 250.0)) #model x, y and z ranges (mm) covered by prediction grids
+GRID_RESOLUTION = (2.0, 2.0, 1.0) #default prediction grid spacing in x, y and z (mm)
+OFF_GRID_CACHE_SIZE = 4096 #predictions kept for points outside a prediction grid
+TERMS = ((0,0,0), (1,0,0), (0,1,0), (0,0,1), (2,0,0), (1,1,0), (0,2,0), (1,0,1), (0,1,1), (0,0,2),
+		 (3,0,0), (2,1,0), (1,2,0), (0,3,0), (2,0,1), (1,1,1), (0,2,1), (1,0,2), (0,1,2), (0,0,3))
+		 #x, y and z exponents of each model coefficient's term
 
-def compensate_z_3d(model_coefficients_path, gcode_path):
+def compensate_z_3d(model_coefficients_path, gcode_path, stream=False, compact=False, parallel=False, packed=False, min_height=None, max_height=None, incremental=False, grid=False, adaptive=False, modal=False, pipelined=False):
 	# Validate arguments
 	if not type(model_coefficients_path) is str:
 		raise TypeError('Unexpected data type for argument lookup_table_path. Expecting str.')
@@ -17,10 +28,104 @@ def compensate_z_3d(model_coefficients_path, gcode_path):
 		raise ValueError('Unexpected file type for lookup table specified. Expecting .csv file.')
 	elif not type(gcode_path) is str:
 		raise TypeError('Unexpected data type for argument gcode_path. Expecting str.')
-	elif not gcode_path.endswith('.gcode'):
-		raise ValueError('Unexpected file type for gcode file specified. Expecting .gcode file.')
+	elif not gcode.is_gcode_filename(gcode_path):
+		raise ValueError('Unexpected file type for gcode file specified. Expecting .gcode file, optionally compressed.')
+	elif not type(stream) is bool:
+		raise TypeError('Unexpected data type for argument stream. Expecting bool.')
+	elif not type(compact) is bool:
+		raise TypeError('Unexpected data type for argument compact. Expecting bool.')
+	elif not type(parallel) is bool:
+		raise TypeError('Unexpected data type for argument parallel. Expecting bool.')
+	elif not type(packed) is bool:
+		raise TypeError('Unexpected data type for argument packed. Expecting bool.')
+	elif parallel and (stream or compact or packed):
+		raise ValueError('Parallel compensation cannot be combined with stream, compact or packed.')
+	elif not (min_height is None or type(min_height) in (int, float)):
+		raise TypeError('Unexpected data type for argument min_height. Expecting float.')
+	elif not (max_height is None or type(max_height) in (int, float)):
+		raise TypeError('Unexpected data type for argument max_height. Expecting float.')
+	elif (min_height is not None or max_height is not None) and (stream or parallel or packed):
+		raise ValueError('Compensating a range of heights cannot be combined with stream, parallel or packed.')
+	elif not type(incremental) is bool:
+		raise TypeError('Unexpected data type for argument incremental. Expecting bool.')
+	elif incremental and (stream or parallel or packed or min_height is not None or max_height is not None):
+		raise ValueError('Incremental compensation cannot be combined with other modes.')
+	elif not type(grid) is bool:
+		raise TypeError('Unexpected data type for argument grid. Expecting bool.')
+	elif not type(adaptive) is bool:
+		raise TypeError('Unexpected data type for argument adaptive. Expecting bool.')
+	elif adaptive and (compact or parallel or packed or incremental or min_height is not None or max_height is not None):
+		raise ValueError('Adaptive segmentation can only be combined with stream.')
+	elif not type(modal) is bool:
+		raise TypeError('Unexpected data type for argument modal. Expecting bool.')
+	elif modal and incremental:
+		raise ValueError('Modal output cannot be combined with incremental.')
+	elif not type(pipelined) is bool:
+		raise TypeError('Unexpected data type for argument pipelined. Expecting bool.')
+	elif pipelined and (compact or parallel or packed or incremental or min_height is not None or max_height is not None):
+		raise ValueError('Pipelining can only be combined with stream and adaptive.')
 
-	# Parse in lookup table
+	# Parse in model coefficients and instantiate compensator using parsed in data
+	# (grid looks predictions up in a grid precomputed once per set of coefficients,
+	# within GridCompensator3D.max_error() of the exact model)
+	with gcode.stage('load_model'):
+		if grid:
+			compensator_model = load_grid_compensator_3d(model_coefficients_path)
+		else:
+			compensator_model = load_compensator_3d(model_coefficients_path)
+
+	# Only recompensate layers whose model inputs changed since the last
+	# incremental run over the same G-code, copying the rest from the previous
+	# output (the first layer is never compensated, see Gcode.z_compensate())
+	if incremental:
+		index = gcode.LayerIndex(gcode_path)
+		model_key = tuple(compensator_model.coeffs)
+		if grid:
+			model_key = (model_key, compensator_model.bounds, compensator_model.resolution,
+				compensator_model.interpolation)
+		with gcode.stage('incremental'):
+			gcode.construct_incremental(gcode_path, gcode.output_filename(gcode_path, '_3d_compensated'),
+				[model_key if i > 0 else None for i in range(0, len(index.layers))],
+				lambda i, layer: layer.z_compensate(compensator_model) if i > 0 else None, index)
+		return
+
+	# Instantiate Gcode object (streaming reads and writes one layer at a time,
+	# compact stores parsed layers in columnar arrays, parallel parses and
+	# compensates layers across a pool of processes, packed reloads the parse
+	# from a .gcpk file next to the gcode file, packing it on first use; with
+	# min_height and/or max_height only the layers in (min_height, max_height]
+	# are parsed and rewritten, with the rest of the file copied unchanged;
+	# adaptive splits moves only where the predicted correction changes by
+	# more than one Z step along them, rather than every SEG_LENGTH_SPLIT mm;
+	# pipelined streams with reading and writing on their own threads)
+	with gcode.stage('load'):
+		if pipelined:
+			g = gcode.GcodePipeline(gcode_path, split=not adaptive)
+		elif stream:
+			g = gcode.GcodeStream(gcode_path, split=not adaptive)
+		elif parallel:
+			g = gcode.GcodeParallel(gcode_path)
+		elif packed:
+			g = gcode.parse_packed(gcode_path)
+		elif min_height is not None or max_height is not None:
+			index = gcode.LayerIndex(gcode_path)
+			(start, stop) = index.layer_range(min_height, max_height)
+			g = gcode.GcodeRange(gcode_path, start, stop, index, compact=compact)
+		else:
+			g = gcode.Gcode(gcode_path, compact=compact, split=not adaptive)
+
+	# Apply model-based Z compensation
+	with gcode.stage('compensate'):
+		if adaptive:
+			g.split_adaptive(compensator_model, Z_CONTROL_RESOLUTION)
+		g.z_compensate(compensator_model)
+
+	# Output Z-compensated G-code (modal drops coordinates, feedrates and
+	# comments that change nothing on the printer, see gcode.ModalWriter)
+	g.construct(gcode.output_filename(gcode_path, '_3d_compensated'), modal)
+
+def load_compensator_3d(model_coefficients_path):
+	"""Parse in a model coefficients CSV file and return a Compensator3D for it."""
 	with open(model_coefficients_path) as model_coefficients_fs:
 		coefficients = [];
 		try:
@@ -29,18 +134,33 @@ def compensate_z_3d(model_coefficients_path, gcode_path):
 				coefficients.append(float(line[0]))
 		except:
 			raise ValueError('Failed to parse in lookup table from CSV file.')
+	return Compensator3D(coefficients)
 
-	# Instantiate compensator using parsed in data
-	compensator_model = Compensator3D(coefficients)
-
-	# Instantiate Gcode object
-	g = gcode.Gcode(gcode_path)
-
-	# Apply model-based Z compensation
-	g.z_compensate(compensator_model)
-
-	# Output Z-compensated G-code
-	g.construct(gcode_path[0:-6] + '_3d_compensated.gcode')
+def load_grid_compensator_3d(model_coefficients_path, grid_path=None, bounds=BUILD_VOLUME,
+		resolution=GRID_RESOLUTION, interpolation='linear'):
+	"""
+	Parse in a model coefficients CSV file and return a GridCompensator3D for it.
+	The grid is loaded from grid_path (defaults to the CSV file with a _grid.npz
+	suffix) if it was saved for the same coefficients and grid settings, otherwise
+	it is computed and saved there for next time.
+	"""
+	compensator = load_compensator_3d(model_coefficients_path)
+	if grid_path is None:
+		grid_path = model_coefficients_path[0:-4] + '_grid.npz'
+	if os.path.exists(grid_path):
+		try:
+			saved = np.load(grid_path)
+			if tuple(saved['coeffs'].tolist()) == tuple(compensator.coeffs) and\
+					saved['bounds'].tolist() == [list(bound) for bound in bounds] and\
+					saved['resolution'].tolist() == list(resolution) and\
+					str(saved['interpolation']) == interpolation:
+				return GridCompensator3D(compensator, bounds, resolution, interpolation,
+						values=saved['values'])
+		except (IOError, KeyError, ValueError):
+			pass #unreadable grid, compute it again
+	grid_compensator = GridCompensator3D(compensator, bounds, resolution, interpolation)
+	grid_compensator.save(grid_path)
+	return grid_compensator
 
 class LayerwiseCompensator:
 	def __init__(self, lookup_table):
@@ -69,16 +189,61 @@ class LayerwiseCompensator:
 		self.blocks.append(Block(lookup_table[1][-1],float('inf'),lookup_table[2][-1])) #extrapolate past error model to keep same per layer offset from last block
 		self.blocks = tuple(self.blocks) #convert to tuple to protect against accidental editing downstream
 
+		# Compile blocks into an interval index: sorted breakpoints, and for each segment
+		# (breakpoints[i], breakpoints[i+1]] the summed offsets of all blocks covering it
+		self.breakpoints = sorted(set([block.start_height for block in self.blocks] +\
+									  [block.end_height for block in self.blocks]))
+		breakpoint_index = dict((height, i) for i, height in enumerate(self.breakpoints))
+		starting = [[] for height in self.breakpoints] #blocks starting at each breakpoint
+		ending = [[] for height in self.breakpoints] #blocks ending at each breakpoint
+		for i, block in enumerate(self.blocks):
+			if not block.start_height < block.end_height:
+				continue #empty or inverted, covers no build height (see Block.get_offset())
+			starting[breakpoint_index[block.start_height]].append(i)
+			ending[breakpoint_index[block.end_height]].append(i)
+		self.segment_offsets = []
+		active_blocks = [] #indices of blocks covering current segment, kept in block order
+		for i in range(0, len(self.breakpoints) - 1):
+			for j in starting[i]:
+				bisect.insort(active_blocks, j)
+			for j in ending[i]:
+				active_blocks.remove(j)
+			total_offset = 0;
+			for j in active_blocks: #sum in block order, same as summing over all blocks
+				total_offset += self.blocks[j].compensation
+			self.segment_offsets.append(total_offset)
+		self.segment_offsets = tuple(self.segment_offsets)
+
 	def get_total_offset(self, build_height):
 		"""
 		Returns sum of offsets specified by (potentially overlapping) blocks.
 		This summing behavior allows more complex conditional compensation schemes.
 		When blocks are non-overlapping, simply return the appropriate offset for the given build height
 		"""
-		total_offset = 0;
-		for block in self.blocks:
-			total_offset += block.get_offset(build_height)
-		return total_offset
+		i = bisect.bisect_left(self.breakpoints, build_height) #breakpoints[i-1] < build_height <= breakpoints[i]
+		if i == 0 or i == len(self.breakpoints):
+			return 0 #outside all blocks
+		return self.segment_offsets[i-1]
+
+	def get_total_offsets(self, build_heights):
+		"""
+		Same as get_total_offset(), for a sequence of build heights in ascending order.
+		Answered in a single pass, merging build heights against the block breakpoints.
+		"""
+		total_offsets = []
+		i = 0
+		prev_build_height = float('-inf')
+		for build_height in build_heights:
+			if build_height < prev_build_height:
+				raise ValueError('Build heights must be sorted in ascending order.')
+			prev_build_height = build_height
+			while i < len(self.breakpoints) and self.breakpoints[i] < build_height:
+				i += 1
+			if i == 0 or i == len(self.breakpoints):
+				total_offsets.append(0) #outside all blocks
+			else:
+				total_offsets.append(self.segment_offsets[i-1])
+		return total_offsets
 
 class Block:
 	def __init__(self,start_height,end_height,compensation):
@@ -129,4 +294,231 @@ class Compensator3D:
 				   self.coeffs[18]*y*(z**2) +\
 				   self.coeffs[19]*z**3,3)
 
+	def get_predicted_errors(self, x, y, z):
+		"""Vectorized get_predicted_error(). x, y and z are arrays of nominal
+		coordinates (any of them may be a scalar, broadcast against the others).
+		Returns a list of predicted errors, one per point, identical to calling
+		get_predicted_error() on each point in turn."""
+		predicted_errors = self.evaluate(x, y, z)
+		predicted_errors, z = np.broadcast_arrays(predicted_errors, z)
+
+		# builtin round() rather than np.round(), which rounds halfway cases differently
+		return [0 if cur_z < 0 else round(predicted_error,3)
+				for predicted_error, cur_z in zip(predicted_errors.tolist(), z.tolist())]
+
+	def evaluate(self, x, y, z):
+		"""Returns the model polynomial at arrays of nominal coordinates x, y and
+		z (broadcast against each other) as an array, without rounding or
+		clamping at z < 0."""
+		x = np.asarray(x, dtype=float)
+		y = np.asarray(y, dtype=float)
+		z = np.asarray(z, dtype=float)
+
+		# Monomial basis. Terms are summed in the same order as get_predicted_error()
+		# so floating point results (and therefore rounding) agree exactly.
+		x2, x3 = _pow(x, 2), _pow(x, 3)
+		y2, y3 = _pow(y, 2), _pow(y, 3)
+		z2, z3 = _pow(z, 2), _pow(z, 3)
+		return self.coeffs[0] +\
+			   self.coeffs[1]*x +\
+			   self.coeffs[2]*y +\
+			   self.coeffs[3]*z +\
+			   self.coeffs[4]*x2 +\
+			   self.coeffs[5]*x*y +\
+			   self.coeffs[6]*y2 +\
+			   self.coeffs[7]*x*z +\
+			   self.coeffs[8]*y*z +\
+			   self.coeffs[9]*z2 +\
+			   self.coeffs[10]*x3 +\
+			   self.coeffs[11]*x2*y +\
+			   self.coeffs[12]*x*y2 +\
+			   self.coeffs[13]*y3 +\
+			   self.coeffs[14]*x2*z +\
+			   self.coeffs[15]*x*y*z +\
+			   self.coeffs[16]*y2*z +\
+			   self.coeffs[17]*x*z2 +\
+			   self.coeffs[18]*y*z2 +\
+			   self.coeffs[19]*z3
+
+class GridCompensator3D:
+	def __init__(self, compensator, bounds=BUILD_VOLUME, resolution=GRID_RESOLUTION,
+			interpolation='linear', cache_size=OFF_GRID_CACHE_SIZE, values=None):
+		"""
+		Drop-in replacement for a Compensator3D, predicting errors from a grid of
+		its predictions precomputed over bounds (x, y and z ranges in model
+		coordinates) at the given resolution (grid spacing in x, y and z).
+		interpolation is 'linear' (trilinear) or 'nearest' (nearest grid point).
+		Predictions for points outside the grid are made by compensator, keeping
+		the last cache_size of them. values, if given, is a grid computed before
+		for the same arguments (see save() and load_grid_compensator_3d()).
+		Results may differ from compensator's by up to max_error().
+		"""
+		if not interpolation in ('linear', 'nearest'):
+			raise ValueError("Unexpected interpolation. Expecting 'linear' or 'nearest'.")
+		elif not (len(bounds) == 3 and len(resolution) == 3):
+			raise ValueError('Unexpected length for bounds or resolution. Expecting x, y and z.')
+		for (low, high), step in zip(bounds, resolution):
+			if not (high > low and step > 0):
+				raise ValueError('Grid bounds must be increasing and resolution positive.')
+
+		self.compensator = compensator
+		self.coeffs = tuple(compensator.coeffs)
+		self.bounds = tuple((float(low), float(high)) for low, high in bounds)
+		self.resolution = tuple(float(step) for step in resolution)
+		self.interpolation = interpolation
+		self.shape = tuple(int(math.ceil((high - low)/step)) + 1
+				for (low, high), step in zip(self.bounds, self.resolution))
+		self.off_grid_cache = collections.OrderedDict()
+		self.cache_size = cache_size
+
+		if values is None:
+			# Evaluate one z plane at a time to bound temporary memory
+			(x_axis, y_axis, z_axis) = [low + step*np.arange(0, n) for (low, high), step, n
+					in zip(self.bounds, self.resolution, self.shape)]
+			(x, y) = np.meshgrid(x_axis, y_axis, indexing='ij')
+			values = np.empty(self.shape)
+			for k, z in enumerate(z_axis.tolist()):
+				values[:,:,k] = compensator.evaluate(x, y, z)
+		elif not values.shape == self.shape:
+			raise ValueError('Unexpected shape for argument values. Expecting %s.' % (self.shape,))
+		self.values = values
+
+	def get_predicted_error(self, x, y, z):
+		"""Same as Compensator3D.get_predicted_error(), looked up in the grid."""
+		if z < 0:
+			return 0
+		indices = [(coordinate - low)/step for coordinate, (low, high), step
+				in zip((x, y, z), self.bounds, self.resolution)]
+		if not all(0 <= index <= n - 1 for index, n in zip(indices, self.shape)):
+			return self._get_off_grid_error(x, y, z)
+		if self.interpolation == 'nearest':
+			# halfway points round up, in _interpolate() too
+			return round(self.values.item(*[int(math.floor(index + 0.5)) for index in indices]),3)
+
+		# Trilinear, one point at a time (see _interpolate())
+		lower = [min(int(index), n - 2) for index, n in zip(indices, self.shape)]
+		(fx, fy, fz) = [index - low for index, low in zip(indices, lower)]
+		(i, j, k) = lower
+		item = self.values.item
+		interpolated_yz = []
+		for cur_i in (i, i + 1):
+			interpolated_z = []
+			for cur_j in (j, j + 1):
+				lower_value = item(cur_i, cur_j, k)
+				interpolated_z.append(lower_value + (item(cur_i, cur_j, k + 1) - lower_value)*fz)
+			interpolated_yz.append(interpolated_z[0] + (interpolated_z[1] - interpolated_z[0])*fy)
+		return round(interpolated_yz[0] + (interpolated_yz[1] - interpolated_yz[0])*fx,3)
+
+	def get_predicted_errors(self, x, y, z):
+		"""Same as Compensator3D.get_predicted_errors(), looked up in the grid."""
+		(x, y, z) = np.broadcast_arrays(np.asarray(x, dtype=float),
+				np.asarray(y, dtype=float), np.asarray(z, dtype=float))
+
+		# Fractional grid indices of each point, and which points fall within the grid
+		indices = [(coordinate - low)/step for coordinate, (low, high), step
+				in zip((x, y, z), self.bounds, self.resolution)]
+		on_grid = np.ones(x.shape, dtype=bool)
+		for index, n in zip(indices, self.shape):
+			on_grid &= (index >= 0) & (index <= n - 1)
+		interpolated = np.zeros(x.shape)
+		interpolated[on_grid] = self._interpolate([index[on_grid] for index in indices])
+
+		if on_grid.all() and (z >= 0).all(): #usual case, nothing to predict exactly
+			return [round(value,3) for value in interpolated.tolist()]
+		predicted_errors = []
+		for cur_x, cur_y, cur_z, is_on_grid, value in zip(x.tolist(), y.tolist(), z.tolist(),
+				on_grid.tolist(), interpolated.tolist()):
+			if cur_z < 0:
+				predicted_errors.append(0)
+			elif is_on_grid:
+				predicted_errors.append(round(value,3))
+			else:
+				predicted_errors.append(self._get_off_grid_error(cur_x, cur_y, cur_z))
+		return predicted_errors
+
+	def _interpolate(self, indices):
+		"""Interpolate the grid at arrays of fractional grid indices."""
+		if self.interpolation == 'nearest':
+			# np.rint() would round halfway points to even, unlike get_predicted_error()
+			return self.values[tuple(np.floor(index + 0.5).astype(int) for index in indices)]
+
+		# Trilinear: interpolate between the 8 corners of each point's grid cell,
+		# gathered from the flattened grid, along z, then y, then x
+		(i, j, k) = [np.minimum(np.floor(index).astype(int), n - 2)
+				for index, n in zip(indices, self.shape)]
+		(fx, fy, fz) = [index - lower for index, lower in zip(indices, (i, j, k))]
+		(nx, ny, nz) = self.shape
+		values = self.values.ravel()
+		corner = (i*ny + j)*nz + k
+		interpolated_yz = []
+		for x_offset in (0, ny*nz):
+			interpolated_z = []
+			for y_offset in (0, nz):
+				lower = values[corner + x_offset + y_offset]
+				upper = values[corner + x_offset + y_offset + 1]
+				interpolated_z.append(lower + (upper - lower)*fz)
+			interpolated_yz.append(interpolated_z[0] + (interpolated_z[1] - interpolated_z[0])*fy)
+		return interpolated_yz[0] + (interpolated_yz[1] - interpolated_yz[0])*fx
+
+	def _get_off_grid_error(self, x, y, z):
+		"""Predict the error at a point outside the grid, with an LRU cache."""
+		key = (x, y, z)
+		if key in self.off_grid_cache:
+			predicted_error = self.off_grid_cache.pop(key)
+		else:
+			predicted_error = self.compensator.get_predicted_error(x, y, z)
+			if len(self.off_grid_cache) >= self.cache_size:
+				self.off_grid_cache.popitem(last=False) #evict least recently used
+		self.off_grid_cache[key] = predicted_error
+		return predicted_error
+
+	def max_interpolation_error(self):
+		"""
+		Returns an upper bound on the difference between the interpolated grid
+		and the exact (unrounded) model polynomial anywhere within the grid:
+		- linear: sum over axes of spacing**2/8 * max |second derivative|
+		- nearest: sum over axes of spacing/2 * max |first derivative|
+		with derivatives bounded term by term using the largest coordinate
+		magnitudes in the grid. Points outside the grid are predicted exactly.
+		"""
+		extents = [max(abs(low), abs(low + step*(n - 1))) for (low, high), step, n
+				in zip(self.bounds, self.resolution, self.shape)]
+		order = 2 if self.interpolation == 'linear' else 1
+		bound = 0
+		for axis, step in enumerate(self.resolution):
+			derivative_bound = 0
+			for coeff, exponents in zip(self.coeffs, TERMS):
+				if exponents[axis] < order:
+					continue
+				term_bound = abs(coeff)
+				for other_axis, exponent in enumerate(exponents):
+					if other_axis == axis:
+						falling_factorial = exponent if order == 1 else exponent*(exponent - 1)
+						term_bound *= falling_factorial*extents[axis]**(exponent - order)
+					else:
+						term_bound *= extents[other_axis]**exponent
+				derivative_bound += term_bound
+			bound += (step**2/8 if order == 2 else step/2)*derivative_bound
+		return bound
+
+	def max_error(self):
+		"""
+		Returns an upper bound on the difference between this and the exact
+		compensator's predictions: max_interpolation_error() rounded up to the
+		next 0.001, as both are rounded to 3 decimals (so any difference at all
+		may show up as 0.001). Differences are exact up to floating point
+		representation of the rounded values.
+		"""
+		return 0.001*max(1, math.ceil(self.max_interpolation_error()/0.001))
+
+	def save(self, grid_path):
+		"""Save the grid to a .npz file, see load_grid_compensator_3d()."""
+		with open(grid_path, 'wb') as grid_fs:
+			np.savez(grid_fs, values=self.values, coeffs=self.coeffs, bounds=self.bounds,
+					resolution=self.resolution, interpolation=self.interpolation)
 
+def _pow(a, exponent):
+	"""Elementwise a**exponent computed with the C library pow() like Python's **.
+	numpy special-cases a scalar exponent of 2 as a multiplication, which can differ
+	from pow() in the last bit."""
+	return np.power(a, np.full(a.shape, float(exponent)))
@@ -0,0 +1,254 @@
+"""
+Combined Z compensation: apply an ordered list of error models to a G-code
+file in a single parse/compensate/write pass, instead of running
+compensate_z_uniform and then compensate_z_3d over its output.
+
+Each model's correction is computed unquantized and summed, and the total is
+quantized to whole Z steps once, at the end, the way compensate_z_uniform
+quantizes (so a single lookup table gives the same output). Output is written to
+  <gcode file name>_combined_compensated.gcode
+
+Example (height-dependent drift, then the XY-dependent surface):
+  python compensate_z_combined.py -u model_fitting/piecewise_compensation_lookup.csv \
+    -m coefficients.csv part.gcode
+"""
+
+import argparse
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs', 'python-gcode'))
+
+import gcode
+import compensate_z_uniform
+import compensate_z_3d
+from compensate_z_uniform import Z_CONTROL_RESOLUTION
+
+def compensate_z_combined(models, gcode_path, stream=False, compact=False, parallel=False, modal=False, pipelined=False):
+	"""
+	Compensate gcode_path with every model in models, an ordered list of
+	('uniform', lookup table CSV path) and ('3d', model coefficients CSV path)
+	tuples, in one pass. stream, compact and parallel are as for
+	compensate_z_3d(), modal as for Gcode.construct(), and pipelined streams
+	with reading and writing on their own threads (see gcode.GcodePipeline).
+	If there are no 3D models, moves are not split and only lines with a Z
+	are parsed (see gcode.MinimalLayer).
+	"""
+	# Validate arguments
+	check_models(models)
+	if not type(gcode_path) is str:
+		raise TypeError('Unexpected data type for argument gcode_path. Expecting str.')
+	elif not gcode.is_gcode_filename(gcode_path):
+		raise ValueError('Unexpected file type for gcode file specified. Expecting .gcode file, optionally compressed.')
+	elif not type(stream) is bool:
+		raise TypeError('Unexpected data type for argument stream. Expecting bool.')
+	elif not type(compact) is bool:
+		raise TypeError('Unexpected data type for argument compact. Expecting bool.')
+	elif not type(parallel) is bool:
+		raise TypeError('Unexpected data type for argument parallel. Expecting bool.')
+	elif parallel and (stream or compact):
+		raise ValueError('Parallel compensation cannot be combined with stream or compact.')
+	elif not type(modal) is bool:
+		raise TypeError('Unexpected data type for argument modal. Expecting bool.')
+	elif not type(pipelined) is bool:
+		raise TypeError('Unexpected data type for argument pipelined. Expecting bool.')
+	elif pipelined and (compact or parallel):
+		raise ValueError('Pipelining cannot be combined with compact or parallel.')
+
+	g = compensated_gcode(models, gcode_path, stream, compact, parallel, pipelined)
+
+	# Output Z-compensated G-code
+	g.construct(gcode.output_filename(gcode_path, '_combined_compensated'), modal)
+
+def check_models(models):
+	"""Raise TypeError or ValueError if models is not a list of models as
+	compensate_z_combined() takes them."""
+	if not type(models) is list:
+		raise TypeError('Unexpected data type for argument models. Expecting list.')
+	elif not models:
+		raise ValueError('Unexpected length for argument models. Expecting at least one model.')
+	for model in models:
+		if not (type(model) is tuple and len(model) == 2 and model[0] in ('uniform', '3d')):
+			raise ValueError("Unexpected model. Expecting ('uniform' or '3d', path) tuple.")
+		elif not type(model[1]) is str:
+			raise TypeError('Unexpected data type for model path. Expecting str.')
+		elif not model[1].endswith('.csv'):
+			raise ValueError('Unexpected file type for model specified. Expecting .csv file.')
+
+def compensated_gcode(models, gcode_path, stream=False, compact=False, parallel=False, pipelined=False):
+	"""
+	Load the models and gcode_path for compensate_z_combined(), returning
+	the Gcode object with the combined compensation applied to its layers,
+	ready to construct() or iter_lines(). Streamed (and pipelined) layers
+	are compensated as they are consumed.
+	"""
+	# Parse in every model and chain their compensators in the given order
+	with gcode.stage('load_model'):
+		compensators = []
+		for kind, path in models:
+			if kind == 'uniform':
+				compensators.append(compensate_z_uniform.load_layerwise_compensator(path))
+			else:
+				compensators.append(compensate_z_3d.load_compensator_3d(path))
+		chain = CompensatorChain(compensators)
+
+	# Instantiate Gcode object, parsing only what the chained compensators need
+	minimal = not chain.point_compensators
+	with gcode.stage('load'):
+		if pipelined:
+			g = gcode.GcodePipeline(gcode_path, minimal=minimal)
+		elif stream:
+			g = gcode.GcodeStream(gcode_path, minimal=minimal)
+		elif parallel:
+			g = gcode.GcodeParallel(gcode_path)
+		else:
+			g = gcode.Gcode(gcode_path, compact=compact and not minimal, minimal=minimal)
+
+	# Apply the combined compensation
+	g.layers = compensate_layers(g.layers, chain)
+	if not (stream or pipelined): #streamed layers are compensated as they are written
+		with gcode.stage('compensate'):
+			g.layers = list(g.layers)
+	return g
+
+def compensate_layers(layers, chain):
+	"""
+	Generator applying a CompensatorChain to an iterable of layers in build
+	order, yielding each layer once it is compensated. Every layer is shifted
+	by the chain's whole-layer correction; the chain's per-point corrections
+	are then applied by z_compensate(), except to the first layer, which
+	Gcode.z_compensate() never compensates either.
+	"""
+	for i, layer in enumerate(layers):
+		(layer_step, point_compensator) = chain.next_layer(layer.z())
+		if layer_step:
+			layer.shift(Z=layer_step)
+		if point_compensator is not None and i > 0:
+			layer.z_compensate(point_compensator)
+		yield layer
+
+class CompensatorChain:
+	def __init__(self, compensators, resolution=Z_CONTROL_RESOLUTION):
+		"""
+		Ordered list of compensators whose corrections are summed and quantized
+		to whole steps of resolution (mm) once, rather than each separately.
+		Compensators providing get_total_offset() (LayerwiseCompensator) correct
+		whole layers; those providing get_predicted_error() (Compensator3D,
+		GridCompensator3D) correct each XY move. Each compensator sees the layer
+		height as corrected by the whole-layer compensators before it, as it
+		would compensating the output of those before it.
+		Whole-layer corrections accumulate over layers and are applied in whole
+		steps as soon as they reach one, exactly as compensate_z_uniform's
+		layer_shifts() does, so a chain of one LayerwiseCompensator reproduces
+		its output.
+		"""
+		if not compensators:
+			raise ValueError('Unexpected length for argument compensators. Expecting at least one.')
+		for compensator in compensators:
+			if not (hasattr(compensator, 'get_total_offset') or
+					hasattr(compensator, 'get_predicted_error')):
+				raise TypeError('Unexpected compensator. Expecting get_total_offset() or get_predicted_error().')
+		self.compensators = tuple(compensators)
+		self.point_compensators = tuple(compensator for compensator in compensators
+				if not hasattr(compensator, 'get_total_offset'))
+		self.resolution = resolution
+		self.cumulative_offset = 0 #sum of whole steps applied to preceding layers
+		self.outstanding_offset = 0 #whole-layer correction not yet applied in steps
+
+	def quantize(self, correction):
+		"""Truncate a correction (mm) to whole steps, toward zero, as
+		compensate_z_uniform.layer_shifts() does."""
+		return int(correction/self.resolution)*self.resolution
+
+	def next_layer(self, build_height):
+		"""
+		Advance the chain by one layer, of uncompensated build height
+		build_height (None if unknown), in build order. Returns a tuple of the
+		whole-layer correction to shift the layer by, in whole steps, and a
+		LayerCompensator to z_compensate() the shifted layer with (None if
+		there are no per-point compensators).
+		"""
+		layer_offset = 0 #unquantized whole-layer correction for this layer
+		heights = [] #build height each per-point compensator sees
+		for compensator in self.compensators:
+			#height once shifted, as layer.z() would return it
+			height = build_height + self.cumulative_offset + layer_offset \
+					if build_height is not None else None
+			if hasattr(compensator, 'get_total_offset'):
+				layer_offset += compensator.get_total_offset(height)
+			else:
+				heights.append(height)
+
+		#apply whole steps only, carrying the rest forward (see layer_shifts())
+		self.outstanding_offset += layer_offset
+		step_offset = 0
+		if self.outstanding_offset >= self.resolution:
+			(num_steps, self.outstanding_offset) = divmod(self.outstanding_offset, self.resolution)
+			step_offset = num_steps*self.resolution
+		layer_step = self.cumulative_offset + step_offset
+		self.cumulative_offset += step_offset
+
+		if not self.point_compensators or build_height is None:
+			return layer_step, None
+		return layer_step, LayerCompensator(self, self.outstanding_offset, heights)
+
+class LayerCompensator:
+	def __init__(self, chain, outstanding_offset, heights):
+		"""
+		A CompensatorChain's per-point compensation for one layer, to pass to
+		Layer.z_compensate() once the layer has been shifted by its whole-layer
+		correction. Predicts the error to remove from each shifted Z so that the
+		sum of outstanding_offset (the whole-layer correction not yet applied
+		in steps) and every per-point correction, evaluated at heights, is
+		applied in whole steps too.
+		"""
+		self.chain = chain
+		self.outstanding_offset = outstanding_offset
+		self.heights = heights
+
+	def get_predicted_error(self, x, y, z):
+		"""Same as Compensator3D.get_predicted_error(), z is ignored in favor
+		of the heights the chain's compensators see."""
+		error = 0
+		for compensator, height in zip(self.chain.point_compensators, self.heights):
+			error += compensator.get_predicted_error(x, y, height)
+		return -self.chain.quantize(self.outstanding_offset - error)
+
+	def get_predicted_errors(self, x, y, z):
+		"""Vectorized get_predicted_error(), one batched call per compensator."""
+		errors = [0]*len(x)
+		for compensator, height in zip(self.chain.point_compensators, self.heights):
+			if hasattr(compensator, 'get_predicted_errors'):
+				predicted_errors = compensator.get_predicted_errors(x, y, height)
+			else:
+				predicted_errors = [compensator.get_predicted_error(cur_x, cur_y, height)
+						for cur_x, cur_y in zip(x, y)]
+			errors = [error + predicted_error
+					for error, predicted_error in zip(errors, predicted_errors)]
+		return [-self.chain.quantize(self.outstanding_offset - error)
+				for error in errors]
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description='Compensate a G-code file with several error models in one pass.')
+	parser.add_argument('gcode_path', metavar='GCODE',
+		help='G-code file to compensate')
+	parser.add_argument('-u', '--uniform', dest='models', action='append', default=[],
+		type=lambda path: ('uniform', path), metavar='CSV',
+		help='piecewise compensation lookup table (repeatable, applied in the order given)')
+	parser.add_argument('-m', '--model-3d', dest='models', action='append', default=[],
+		type=lambda path: ('3d', path), metavar='CSV',
+		help='3D error model coefficients (repeatable, applied in the order given)')
+	parser.add_argument('-s', '--stream', action='store_true',
+		help='parse and write one layer at a time')
+	parser.add_argument('-c', '--compact', action='store_true',
+		help='store parsed layers in columnar arrays')
+	parser.add_argument('-p', '--parallel', action='store_true',
+		help='parse and compensate layers across a pool of processes')
+	parser.add_argument('-M', '--modal', action='store_true',
+		help='drop coordinates, feedrates and comments that change nothing from the output')
+	parser.add_argument('-P', '--pipelined', action='store_true',
+		help='stream with reading and writing on their own threads')
+	args = parser.parse_args()
+
+	compensate_z_combined(args.models, args.gcode_path, args.stream, args.compact, args.parallel,
+		args.modal, args.pipelined)
@@ -1,3 +1,4 @@
+import bisect
 import csv
 import re
 import sys
@@ -8,7 +9,7 @@ import gcode
 #define global parameters
 Z_CONTROL_RESOLUTION = 0.0105833 #mm per full step
 
-def compensate_z_uniform(lookup_table_path, gcode_path):
+def compensate_z_uniform(lookup_table_path, gcode_path, stream=False, compact=False, parallel=False, packed=False, min_height=None, incremental=False, minimal=None, modal=False, pipelined=False):
 	# Validate arguments
 	if not type(lookup_table_path) is str:
 		raise TypeError('Unexpected data type for argument lookup_table_path. Expecting str.')
@@ -16,10 +17,105 @@ def compensate_z_uniform(lookup_table_path, gcode_path):
 		raise ValueError('Unexpected file type for lookup table specified. Expecting .csv file.')
 	elif not type(gcode_path) is str:
 		raise TypeError('Unexpected data type for argument gcode_path. Expecting str.')
-	elif not gcode_path.endswith('.gcode'):
-		raise ValueError('Unexpected file type for gcode file specified. Expecting .gcode file.')
+	elif not gcode.is_gcode_filename(gcode_path):
+		raise ValueError('Unexpected file type for gcode file specified. Expecting .gcode file, optionally compressed.')
+	elif not type(stream) is bool:
+		raise TypeError('Unexpected data type for argument stream. Expecting bool.')
+	elif not type(compact) is bool:
+		raise TypeError('Unexpected data type for argument compact. Expecting bool.')
+	elif not type(parallel) is bool:
+		raise TypeError('Unexpected data type for argument parallel. Expecting bool.')
+	elif not type(packed) is bool:
+		raise TypeError('Unexpected data type for argument packed. Expecting bool.')
+	elif parallel and (stream or compact or packed):
+		raise ValueError('Parallel compensation cannot be combined with stream, compact or packed.')
+	elif not (min_height is None or type(min_height) in (int, float)):
+		raise TypeError('Unexpected data type for argument min_height. Expecting float.')
+	elif min_height is not None and (stream or parallel or packed):
+		raise ValueError('Compensating above min_height cannot be combined with stream, parallel or packed.')
+	elif not type(incremental) is bool:
+		raise TypeError('Unexpected data type for argument incremental. Expecting bool.')
+	elif incremental and (stream or parallel or packed or min_height is not None):
+		raise ValueError('Incremental compensation cannot be combined with other modes.')
+	elif not (minimal is None or type(minimal) is bool):
+		raise TypeError('Unexpected data type for argument minimal. Expecting bool.')
+	elif minimal and (compact or parallel or packed or min_height is not None or incremental):
+		raise ValueError('Minimal parsing can only be combined with stream.')
+	elif not type(modal) is bool:
+		raise TypeError('Unexpected data type for argument modal. Expecting bool.')
+	elif modal and incremental:
+		raise ValueError('Modal output cannot be combined with incremental.')
+	elif not type(pipelined) is bool:
+		raise TypeError('Unexpected data type for argument pipelined. Expecting bool.')
+	elif pipelined and (compact or parallel or packed or min_height is not None or incremental):
+		raise ValueError('Pipelining can only be combined with stream and minimal.')
 
-	# Parse in lookup table
+	# The layerwise compensator only shifts whole layers in Z, so unless told
+	# otherwise parse minimally whenever no other mode needs parsed layers
+	if minimal is None:
+		minimal = not (compact or parallel or packed or min_height is not None or incremental)
+
+	# Parse in lookup table and instantiate compensator using parsed in data
+	with gcode.stage('load_model'):
+		piecewise_compensator = load_layerwise_compensator(lookup_table_path)
+
+	# Only recompensate layers whose Z shift changed since the last incremental
+	# run over the same G-code, copying the rest from the previous output
+	if incremental:
+		index = gcode.LayerIndex(gcode_path)
+		shifts = list(layer_shifts([layer[4] for layer in index.layers], piecewise_compensator))
+		with gcode.stage('incremental'):
+			gcode.construct_incremental(gcode_path, gcode.output_filename(gcode_path, '_compensated'),
+				shifts, lambda i, layer: shift_layer(layer, shifts[i]), index)
+		return
+
+	# Instantiate Gcode object (streaming reads and writes one layer at a time,
+	# compact stores parsed layers in columnar arrays, parallel parses and
+	# compensates layers across a pool of processes, packed reloads the parse
+	# from a .gcpk file next to the gcode file, packing it on first use; with
+	# min_height only the layers above it are parsed and split, with the
+	# preamble copied unchanged and the layers below it only read minimally
+	# (their offsets carry forward, so they are shifted too, see below);
+	# minimal, chosen above, only tokenizes lines with a Z, which is all
+	# shifting whole layers needs, writing the rest back verbatim without
+	# splitting moves; pipelined streams with reading and writing on their
+	# own threads)
+	with gcode.stage('load'):
+		if pipelined:
+			g = gcode.GcodePipeline(gcode_path, minimal=minimal)
+		elif stream:
+			g = gcode.GcodeStream(gcode_path, minimal=minimal)
+		elif parallel:
+			g = gcode.GcodeParallel(gcode_path)
+		elif packed:
+			g = gcode.parse_packed(gcode_path)
+		elif min_height is not None:
+			index = gcode.LayerIndex(gcode_path)
+			start = index.layer_range(min_height)[0]
+			g = gcode.GcodeRange(gcode_path, start, index=index, compact=compact,
+				minimal_prefix=True)
+		else:
+			g = gcode.Gcode(gcode_path, compact=compact, minimal=minimal)
+
+	# Apply Z-offset to individual layers
+	# (offsets of the layers below min_height carry forward into the range,
+	# so they are shifted as well, or Z would jump at the boundary)
+	if min_height is not None:
+		with gcode.stage('compensate'):
+			layers = list(shift_layers(g.prefix_layers + g.layers, piecewise_compensator))
+		(g.prefix_layers, g.layers) = (layers[0:start], layers[start:])
+	else:
+		g.layers = shift_layers(g.layers, piecewise_compensator)
+		if not (stream or pipelined): #streamed layers are shifted as they are written
+			with gcode.stage('compensate'):
+				g.layers = list(g.layers)
+
+	# Output Z-compensated G-code (modal drops coordinates, feedrates and
+	# comments that change nothing on the printer, see gcode.ModalWriter)
+	g.construct(gcode.output_filename(gcode_path, '_compensated'), modal)
+
+def load_layerwise_compensator(lookup_table_path):
+	"""Parse in a lookup table CSV file and return a LayerwiseCompensator for it."""
 	with open(lookup_table_path) as lookup_table_fs:
 		lookup_table = [[],[],[]];
 		try:
@@ -30,26 +126,58 @@ def compensate_z_uniform(lookup_table_path, gcode_path):
 				lookup_table[2].append(float(line[2])) #compensation
 		except:
 			raise ValueError('Failed to parse in lookup table from CSV file.')
+	return LayerwiseCompensator(lookup_table)
 
-	# Instantiate compensator using parsed in data
-	piecewise_compensator = LayerwiseCompensator(lookup_table)
-
-	# Instantiate Gcode object
-	g = gcode.Gcode(gcode_path)
+def shift_layers(layers, piecewise_compensator):
+	"""
+	Generator applying piecewise compensation to an iterable of layers in build order.
+	Each layer is yielded once all offsets affecting it have been applied, so layers
+	can be written out as soon as they are yielded.
+	Every full step offset shifts all following layers too, so the running total of
+	offsets applied so far is carried forward and each layer is shifted exactly once.
+	"""
+	layers = iter(layers)
+	pending_layers = [] #layer whose build height was last passed to layer_shifts()
+	def build_heights():
+		for layer in layers:
+			pending_layers.append(layer)
+			yield layer.z() #get build height for this layer
+	for shift in layer_shifts(build_heights(), piecewise_compensator):
+		if pending_layers:
+			layer = pending_layers.pop()
+			shift_layer(layer, shift)
+			yield layer
 
-	# Apply Z-offset to individual layers
+def layer_shifts(build_heights, piecewise_compensator):
+	"""
+	Generator yielding, for each uncompensated build height of an iterable of layers
+	in build order, the Z shift shift_layers() applies to that layer: a tuple of the
+	sum of full step offsets applied to preceding layers, and the layer's own full
+	step offset (0 if none).
+	These are all that is needed to compensate a layer, see shift_layer().
+	"""
+	cumulative_offset = 0 #sum of full step offsets applied to preceding layers
 	outstanding_offset_to_apply = 0 #cumulative variable for remaining offset to apply
-	for i in range(0,len(g.layers)):
-		cur_build_height = g.layers[i].z() #get build height for this layer
+	for cur_build_height in build_heights:
+		if cumulative_offset and cur_build_height is not None:
+			cur_build_height += cumulative_offset #height once shifted, as layer.z() would return
 		offset_reqd = piecewise_compensator.get_total_offset(cur_build_height)
 		outstanding_offset_to_apply += offset_reqd
+		step_offset = 0
 		if outstanding_offset_to_apply >= Z_CONTROL_RESOLUTION:
 			(num_steps_to_apply,residual_offset) = divmod(outstanding_offset_to_apply,Z_CONTROL_RESOLUTION)
-			g.shift(i,Z=num_steps_to_apply*Z_CONTROL_RESOLUTION) #apply offset in full Z steps only
+			step_offset = num_steps_to_apply*Z_CONTROL_RESOLUTION #apply offset in full Z steps only
 			outstanding_offset_to_apply = residual_offset #keep track of remaining offset to apply
+		yield (cumulative_offset, step_offset)
+		cumulative_offset += step_offset
 
-	# Output Z-compensated G-code
-	g.construct(gcode_path[0:-6] + '_compensated.gcode')
+def shift_layer(layer, shift):
+	"""Apply a shift from layer_shifts() to a layer."""
+	(cumulative_offset, step_offset) = shift
+	if cumulative_offset:
+		layer.shift(Z=cumulative_offset)
+	if step_offset:
+		layer.shift(Z=step_offset)
 
 class LayerwiseCompensator:
 	def __init__(self, lookup_table):
@@ -78,16 +206,61 @@ class LayerwiseCompensator:
 		self.blocks.append(Block(lookup_table[1][-1],float('inf'),lookup_table[2][-1])) #extrapolate past error model to keep same per layer offset from last block
 		self.blocks = tuple(self.blocks) #convert to tuple to protect against accidental editing downstream
 
+		# Compile blocks into an interval index: sorted breakpoints, and for each segment
+		# (breakpoints[i], breakpoints[i+1]] the summed offsets of all blocks covering it
+		self.breakpoints = sorted(set([block.start_height for block in self.blocks] +\
+									  [block.end_height for block in self.blocks]))
+		breakpoint_index = dict((height, i) for i, height in enumerate(self.breakpoints))
+		starting = [[] for height in self.breakpoints] #blocks starting at each breakpoint
+		ending = [[] for height in self.breakpoints] #blocks ending at each breakpoint
+		for i, block in enumerate(self.blocks):
+			if not block.start_height < block.end_height:
+				continue #empty or inverted, covers no build height (see Block.get_offset())
+			starting[breakpoint_index[block.start_height]].append(i)
+			ending[breakpoint_index[block.end_height]].append(i)
+		self.segment_offsets = []
+		active_blocks = [] #indices of blocks covering current segment, kept in block order
+		for i in range(0, len(self.breakpoints) - 1):
+			for j in starting[i]:
+				bisect.insort(active_blocks, j)
+			for j in ending[i]:
+				active_blocks.remove(j)
+			total_offset = 0;
+			for j in active_blocks: #sum in block order, same as summing over all blocks
+				total_offset += self.blocks[j].compensation
+			self.segment_offsets.append(total_offset)
+		self.segment_offsets = tuple(self.segment_offsets)
+
 	def get_total_offset(self, build_height):
 		"""
 		Returns sum of offsets specified by (potentially overlapping) blocks.
 		This summing behavior allows more complex conditional compensation schemes.
 		When blocks are non-overlapping, simply return the appropriate offset for the given build height
 		"""
-		total_offset = 0;
-		for block in self.blocks:
-			total_offset += block.get_offset(build_height)
-		return total_offset
+		i = bisect.bisect_left(self.breakpoints, build_height) #breakpoints[i-1] < build_height <= breakpoints[i]
+		if i == 0 or i == len(self.breakpoints):
+			return 0 #outside all blocks
+		return self.segment_offsets[i-1]
+
+	def get_total_offsets(self, build_heights):
+		"""
+		Same as get_total_offset(), for a sequence of build heights in ascending order.
+		Answered in a single pass, merging build heights against the block breakpoints.
+		"""
+		total_offsets = []
+		i = 0
+		prev_build_height = float('-inf')
+		for build_height in build_heights:
+			if build_height < prev_build_height:
+				raise ValueError('Build heights must be sorted in ascending order.')
+			prev_build_height = build_height
+			while i < len(self.breakpoints) and self.breakpoints[i] < build_height:
+				i += 1
+			if i == 0 or i == len(self.breakpoints):
+				total_offsets.append(0) #outside all blocks
+			else:
+				total_offsets.append(self.segment_offsets[i-1])
+		return total_offsets
 
 class Block:
 	def __init__(self,start_height,end_height,compensation):
@@ -3,8 +3,92 @@ Based on python_gcode (https://github.com/fetlab/python_gcode) by (https://githu
 Licensed and modified under the MIT License by Shien Yang Lee (https://github.com/syl405).
 """
 
-import re, sys, warnings, copy
+import re, os, sys, io, copy, gzip, math, mmap, time, json, struct, hashlib, warnings, itertools
+import collections, contextlib, multiprocessing, subprocess, threading, Queue, cPickle, cProfile
+from array import array
+from distutils.spawn import find_executable
 SEG_LENGTH_SPLIT = 3 #segment lengths to split moves into (in mm)
+WRITE_BUFFER_SIZE = 1 << 20 #bytes buffered when writing out gcode files
+METADATA_DEPENDS_ON = (('extents', 'XY'), ('total_extrusion', 'E'),
+	('path_length', 'XYZ')) #args each cached layer property depends on
+
+#CompactLayer storage
+ARG_ORDER = tuple(dict.fromkeys('XYZEF')) #order Line.args dicts iterate these in, so rows construct identically
+ARG_BITS = dict((arg, 1 << i) for i, arg in enumerate(ARG_ORDER))
+XY_BITS = ARG_BITS['X'] | ARG_BITS['Y']
+CODES = ['G0', 'G1'] #code enum, grows as new codes are seen
+CODE_INDEX = dict((code, i) for i, code in enumerate(CODES))
+OTHER = 255 #code enum value for lines not stored in the arrays
+
+#Serialization
+class ArgFormats(dict):
+	"""Format strings for each argument name, compiled on first use."""
+	def __missing__(self, arg):
+		fmt = self[arg] = ' %s%%s' % (arg if arg is not None else '')
+		return fmt
+ARG_FORMATS = ArgFormats()
+
+#Packed files, see Gcode.pack()
+PACK_MAGIC = 'GCPK'
+PACK_VERSION = 2
+PACK_HEADER = struct.Struct('<4sIQ') #magic, version, offset of the pickled index
+PACK_COLUMNS = (('codes', 'B'), ('present', 'B'), ('ints', 'B'), ('comments', 'H')) +\
+	tuple((arg, 'd') for arg in ARG_ORDER) #order of each layer's arrays in the file
+CACHE_SUFFIX = '.cache' #added to output file names for construct_incremental()
+
+#Compressed files, see open_gcode()
+CODEC_COMMANDS = collections.OrderedDict([('.gz', ('pigz', 'gzip')), ('.xz', ('xz',)),
+	('.zst', ('zstd',))]) #compressed file suffixes and the commands (de)compressing them
+COMPRESS_LEVELS = {'.gz': 6, '.xz': 3, '.zst': 3} #levels compressed files are written at
+
+#Instrumentation, see Instrumentation
+instrumentation = None #the enabled Instrumentation, if any
+
+#Tokenizer
+ARG_LETTERS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+RAW_ARG_CODES = frozenset(['M117', 'M38', '\\nM38']) #codes whose arguments are kept as one raw string
+LAYER_CHANGE = re.compile(r'G[01]\s+Z-?\.?\d+') #Slic3r layer change: a G0 or G1 with a Z
+CURA_LAYER = re.compile(r';LAYER:\d+$') #Cura layer change comment
+Z_ARG = re.compile(r'(?<=\s)Z[^\s;]*') #Z argument of a line, see MinimalLayer
+
+def tokenize(line):
+	"""Split a single line of gcode into its code, named arguments and
+	comment, without any regular expressions. Returns a tuple of (line
+	with the comment stripped, code, args, comment); code and args are
+	None for comment-only lines."""
+	if line.lstrip()[:1] == ';': #comment-only line
+		return line, None, None, line[line.index(';')+1:]
+
+	comment = None
+	if ';' in line:
+		line, comment = line.split(';', 1)
+
+	tokens = line.split()
+	code = tokens[0]
+	args = {}
+	if code in RAW_ARG_CODES:
+		args[None] = line.split(None, 1)[1]
+		return line, code, args, comment
+
+	for arg in tokens[1:]:
+		letter = arg[0]
+		if letter in ARG_LETTERS:
+			value = arg[1:]
+			if value:
+				try:
+					#only convert to float if decimal point present
+					args[letter] = float(value) if '.' in value else int(value)
+				except ValueError:
+					sys.stderr.write("Line: %s\n" % (line if comment is None
+						else line + ';' + comment))
+					sys.stderr.write("Code: %s\n" % code)
+					sys.stderr.write("args: %s\n" % tokens)
+					raise
+			else:
+				args[letter] = None
+		else:
+			args[None] = arg
+	return line, code, args, comment
 
 class Point(object):
 	def __init__(self, X, Y, Z):
@@ -34,39 +118,10 @@ class Line(object):
 			if not (args and code):
 				raise ValueError("Both code and args must be specified")
 		else:
-			#Check for comment-only lines
-			if re.match(r'\s*;', line):
-				self.comment = line[line.index(';')+1:]
-			else:
-				#Extract the comment if there is one
-				lc = self.line.split(';', 1)
-				if len(lc) > 1:
-					self.line, self.comment = lc
-
-				#Get the actual code and the arguments
-				args = self.line.split()
-				self.code = args[0]
-				self.args = {}
-				if self.code == 'M117' or self.code == 'M38' or self.code == '\\nM38':
-					self.args[None] = self.line.split(None, 1)[1]
-				else:
-					for arg in args[1:]:
-						if re.match('[A-Za-z]', arg[0]):
-							if arg[1:] is not None and arg[1:] != '':
-								try:
-									#only convert to float if decimal point present
-									self.args[arg[0]] = float(arg[1:])\
-									 if '.' in arg[1:]\
-									  else int(arg[1:]) 
-								except ValueError:
-									sys.stderr.write("Line: %s\n" % line)
-									sys.stderr.write("Code: %s\n" % self.code)
-									sys.stderr.write("args: %s\n" % args)
-									raise
-							else:
-								self.args[arg[0]] = None
-						else:
-							self.args[None] = arg
+			self.line, code, args, self.comment = tokenize(line)
+			if code is not None: #not a comment-only line
+				self.code = code
+				self.args = args
 
 		# determine destination specified by current line
 		[X,Y,Z] = self.initial_point.get_coordinates() #default to no movemente
@@ -108,12 +163,10 @@ class Line(object):
 
 	def get_length(self):
 		"""returns length of current line in 3-space (XYZ)"""
-		return ((self.final_point.get_coordinates()[0]\
-			     -self.initial_point.get_coordinates()[0])**2  +\
-				(self.final_point.get_coordinates()[1]\
-				 -self.initial_point.get_coordinates()[1])**2 + \
-				(self.final_point.get_coordinates()[2]\
-				 -self.initial_point.get_coordinates()[2])**2)**0.5 # pythagorus' theorem
+		initial_point, final_point = self.initial_point, self.final_point
+		return ((final_point.X - initial_point.X)**2 +\
+				(final_point.Y - initial_point.Y)**2 +\
+				(final_point.Z - initial_point.Z)**2)**0.5 # pythagorus' theorem
 
 	def get_code(self):
 		return self.code
@@ -127,117 +180,120 @@ class Line(object):
 	def get_final_point(self):
 		return self.final_point
 
-	def split_move(self,segment_length):
+	def split_move(self,segment_length,n_segments=None):
 		"""if current move is longer than segment_length (provided in mm), 
 		split into segments of specified length (put single short line from remainder at end)
-		and return list of lines. else return single-element list containing self."""
+		and return list of lines. else return single-element list containing self.
+		n_segments, if given, is the number of full length segments to make
+		before the last one, see split_evenly()."""
 
 		if self.length <= segment_length:
 			return [self]
-		else:
-			#calculate number of segments into which to split current line; short segment at end
+
+		(segment_points, E_full_length_segments, E_last_segment) =\
+			self.split_coordinates(segment_length, n_segments)
+
+		list_of_constituent_lines = []
+		prev_point = self.initial_point
+		for (i, (cur_X, cur_Y, cur_Z)) in enumerate(segment_points):
+			#make next segment with arguments copied over from unsplit line
+			#(values are immutable so a shallow copy will do)
+			cur_args = dict(self.args)
+			#update XYZ destination with incremental values
+			cur_args['X'] = cur_X
+			cur_args['Y'] = cur_Y
+			cur_args['Z'] = cur_Z
+			cur_args['E'] = E_full_length_segments
+			if i > 0 and 'F' in cur_args: #explicitly specify feedrate only for first segment
+				del cur_args['F']
+			incremental_line = Line('', prev_point, self.code, cur_args, 'splt')
+			prev_point = incremental_line.final_point
+
+			#append next segment to list of split moves
+			list_of_constituent_lines.append(incremental_line)
+
+		#instantiate last time (this segment may be shorter than the specified segment length)
+		last_line_args = dict(self.args)
+		last_line_args['E'] = E_last_segment
+		if 'F' in last_line_args: #do not explicitly specify feedrate for last line
+			del last_line_args['F']
+		last_line = Line('', prev_point, self.code, last_line_args, 'end splt')
+		list_of_constituent_lines.append(last_line)
+
+		#sanity check
+		if last_line.final_point.get_coordinates() != \
+		self.final_point.get_coordinates():
+			raise ValueError('Split line not coming back to original destination.')
+
+		return list_of_constituent_lines
+
+	def split_evenly(self, n):
+		"""Split current move into n segments of equal length, returning
+		the list of lines (a single-element list containing self if n is 1)."""
+		if n <= 1:
+			return [self]
+		#n-1 full length segments, with the last one taking up the remainder
+		return self.split_move(self.length/float(n), n - 1)
+
+	def split_coordinates(self, segment_length, n_segments=None):
+		"""Compute how split_move() divides this line into segments of
+		segment_length, without building any Line objects. Returns a tuple
+		of (list of rounded XYZ destinations of the full length segments,
+		E for each full length segment, E for the final short segment
+		ending at this line's destination)."""
+		#calculate number of segments into which to split current line; short segment at end
+		if n_segments is None:
 			n_segments = int(self.length//segment_length)
 
-			#calculate direction cosines
-			if 'X' in self.args:
-				X_hat = (self.args['X'] - self.initial_point.get_coordinates()[0])/float(self.length)
-			else:
-				X_hat = float(0)
-			if 'Y' in self.args:
-				Y_hat = (self.args['Y'] - self.initial_point.get_coordinates()[1])/float(self.length)
-			else:
-				Y_hat = float(0)
-			if 'Z' in self.args:
-				Z_hat = (self.args['Z'] - self.initial_point.get_coordinates()[2])/float(self.length)
-			else:
-				Z_hat = float(0)
-
-			#debug
-			if self.line == 'G0 X0 Y1000 F10800.0 ':
-				print 'direction: (%f,%f,%f)' % (X_hat,Y_hat,Z_hat)
-				print 'magnitude: %f' % self.length
-				print 'initial: (%f,%f,%f)' % (
-					self.initial_point.get_coordinates()[0],
-					self.initial_point.get_coordinates()[1],
-					self.initial_point.get_coordinates()[2])
-				print 'final: (%f,%f,%f)' % (
-					self.final_point.get_coordinates()[0],
-					self.final_point.get_coordinates()[1],
-					self.final_point.get_coordinates()[2])
-
-			#calculate extrusion length for each segment
-			E_full_length_segments = round(self.args['E'] *\
-				(float(segment_length)/self.length),3) #distribute filament length by print length
-			E_last_segment = round(self.args['E'] *\
-				((self.length - (float(segment_length)*n_segments))/self.length),3)
-
-			#instantiate first line (this is redundant move with zero length)
-			first_line_args = copy.deepcopy(self.args)
-			first_line_args['X'] = self.get_initial_point().get_coordinates()[0]
-			first_line_args['Y'] = self.get_initial_point().get_coordinates()[1]
-			first_line_args['Z'] = self.get_initial_point().get_coordinates()[2]
-			first_line_args['E'] = 0
-			list_of_constituent_lines = [Line('',\
-										 self.get_initial_point(),\
-										 self.code,\
-										 first_line_args,\
-										 'begin splt')]
-
-			for i in range(1,n_segments+1): #exclude redundant first line
-				cur_X = round(self.initial_point.get_coordinates()[0] + i*segment_length*X_hat,3)
-				cur_Y = round(self.initial_point.get_coordinates()[1] + i*segment_length*Y_hat,3)
-				cur_Z = round(self.initial_point.get_coordinates()[2] + i*segment_length*Z_hat,3)
-
-				#make next segment
-				cur_args = copy.deepcopy(self.args) #copy over arguments from unsplit line
-				#update XYZ destination with incremental values
-				cur_args['X'] = cur_X
-				cur_args['Y'] = cur_Y
-				cur_args['Z'] = cur_Z
-				cur_args['E'] = E_full_length_segments
-				if i > 1 and 'F' in cur_args: #explicitly specify feedrate only for first segment
-					del cur_args['F']
-				incremental_line = Line(
-					'', 
-					list_of_constituent_lines[-1].get_final_point(), 
-					self.code, cur_args, 
-					'splt')
-
-
-				#append next segment to list of split moves
-				list_of_constituent_lines.append(incremental_line)
-
-			#instantiate last time (this segment may be shorter than the specified segment length)
-			last_line_args = copy.deepcopy(self.args)
-			last_line_args['E'] = E_last_segment
-			if 'F' in last_line_args: #do not explicitly specify feedrate for last line
-				del last_line_args['F']
-			last_line = Line(
-				'', 
-				list_of_constituent_lines[-1].get_final_point(), 
-				self.code, last_line_args, 
-				'end splt')
-			list_of_constituent_lines.append(last_line)
-
-			#remove redundant first line (a redundant line going nowhere causes printer to hesitate)
-			del list_of_constituent_lines[0]
-
-			#sanity check
-			if list_of_constituent_lines[-1].get_final_point().get_coordinates() != \
-			self.final_point.get_coordinates():
-				raise ValueError('Split line not coming back to original destination.')
-
-			return list_of_constituent_lines
+		#calculate direction cosines
+		[X0, Y0, Z0] = self.initial_point.get_coordinates()
+		if 'X' in self.args:
+			X_hat = (self.args['X'] - X0)/float(self.length)
+		else:
+			X_hat = float(0)
+		if 'Y' in self.args:
+			Y_hat = (self.args['Y'] - Y0)/float(self.length)
+		else:
+			Y_hat = float(0)
+		if 'Z' in self.args:
+			Z_hat = (self.args['Z'] - Z0)/float(self.length)
+		else:
+			Z_hat = float(0)
+
+		#debug
+		if self.line == 'G0 X0 Y1000 F10800.0 ':
+			print 'direction: (%f,%f,%f)' % (X_hat,Y_hat,Z_hat)
+			print 'magnitude: %f' % self.length
+			print 'initial: (%f,%f,%f)' % (X0, Y0, Z0)
+			print 'final: (%f,%f,%f)' % (
+				self.final_point.X,
+				self.final_point.Y,
+				self.final_point.Z)
+
+		#calculate extrusion length for each segment
+		E_full_length_segments = round(self.args['E'] *\
+			(float(segment_length)/self.length),3) #distribute filament length by print length
+		E_last_segment = round(self.args['E'] *\
+			((self.length - (float(segment_length)*n_segments))/self.length),3)
+
+		segment_points = [(round(X0 + i*segment_length*X_hat,3),
+						   round(Y0 + i*segment_length*Y_hat,3),
+						   round(Z0 + i*segment_length*Z_hat,3))
+						  for i in range(1,n_segments+1)]
+
+		return segment_points, E_full_length_segments, E_last_segment
 
 	def construct(self):
 		"""Construct and return a line of gcode based on self.code and
 		self.args."""
 		if not self.code:
 			return ';%s' % self.comment
-		return ' '.join([self.code] +
-				['%s%s' % (k if k is not None else '', v if v is not None else '')
-					for k,v in self.args.iteritems()]) +\
-		(' ;%s' % self.comment if self.comment else '')
+		s = self.code
+		for k,v in self.args.iteritems():
+			s += ARG_FORMATS[k] % (v if v is not None else '')
+		if self.comment:
+			s += ' ;' + self.comment
+		return s
 
 class Layer(object):
 	def __init__(self, prev_layer_final_pt, lines=[], split=True, layernum=None, explicit=True):
@@ -251,9 +307,11 @@ class Layer(object):
 		lines[0],
 		prev_layer_final_pt,
 		explicit=explicit) #make Line object from unsplit first line
+		moves_split = 0
 		if first_line_in_layer.get_code() in ['G0','G1'] and split: #only split move lines
 			split_first_line_in_layer = first_line_in_layer.split_move(SEG_LENGTH_SPLIT)
 			self.lines += split_first_line_in_layer # initialize list of lines with split 1st line
+			moves_split += len(split_first_line_in_layer) > 1
 		else:
 			self.lines += [first_line_in_layer]
 
@@ -263,13 +321,26 @@ class Layer(object):
 			if cur_line.get_code() in ['G0','G1'] and 'E' in cur_line.get_args() and split:
 				split_cur_line = cur_line.split_move(SEG_LENGTH_SPLIT)
 				self.lines += split_cur_line
+				moves_split += len(split_cur_line) > 1
 			else:
 				self.lines += [cur_line]
 
+		if instrumentation:
+			instrumentation.count('layers_parsed')
+			instrumentation.count('lines_parsed', len(lines))
+			instrumentation.count('moves_split', moves_split)
+			#each split move is replaced by its segments
+			instrumentation.count('segments_emitted', len(self.lines) - len(lines) + moves_split)
+
 		#calculate initial and final points in this layer
 		self.initial_point = self.lines[0].get_initial_point() #intial pt in first line
 		self.final_point = self.lines[-1].get_final_point() #final pt in last line
 
+		#cache the line setting the layer height; other derived properties
+		#are cached by name in self.metadata as they are first requested
+		self.z_line = next((l for l in self.lines if 'Z' in l.args), None)
+		self.metadata = {}
+
 	def __repr__(self):
 		return '<Layer %s at Z=%s; corners: (%s, %s), (%d, %d); %d lines>' % (
 				(self.layernum, self.z()) + self.extents() + (len(self.lines),))
@@ -282,14 +353,23 @@ class Layer(object):
 		"""returns last XYZ coordinate point in this layer"""
 		return self.final_point
 
+	def copy(self):
+		"""Return an independent copy of this layer."""
+		return copy.deepcopy(self)
+
 	def extents(self):
 		"""Return the extents of the layer: the min/max in x and y that
 		occur. Note this does not take arcs into account."""
-		min_x = min(self.lines, key=lambda l: l.args.get('X', float('inf'))).args['X']
-		min_y = min(self.lines, key=lambda l: l.args.get('Y', float('inf'))).args['Y']
-		max_x = max(self.lines, key=lambda l: l.args.get('X', float('-inf'))).args['X']
-		max_y = max(self.lines, key=lambda l: l.args.get('Y', float('-inf'))).args['Y']
-		return min_x, min_y, max_x, max_y
+		#cache the lines holding the extents rather than their values, so
+		#shifting (which preserves ordering) does not invalidate them
+		if 'extents' not in self.metadata:
+			self.metadata['extents'] = (
+				min(self.lines, key=lambda l: l.args.get('X', float('inf'))),
+				min(self.lines, key=lambda l: l.args.get('Y', float('inf'))),
+				max(self.lines, key=lambda l: l.args.get('X', float('-inf'))),
+				max(self.lines, key=lambda l: l.args.get('Y', float('-inf'))))
+		min_x, min_y, max_x, max_y = self.metadata['extents']
+		return min_x.args['X'], min_y.args['Y'], max_x.args['X'], max_y.args['Y']
 
 
 	def extents_gcode(self):
@@ -303,9 +383,38 @@ class Layer(object):
 		"""Return the first Z height found for this layer. It should be
 		the only Z unless it's been messed with, so returning the first is
 		safe."""
-		for l in self.lines:
-			if 'Z' in l.args:
-				return l.args['Z']
+		if self.z_line is not None:
+			return self.z_line.args['Z']
+
+	def total_extrusion(self):
+		"""Return the sum of E over all moves in this layer."""
+		if 'total_extrusion' not in self.metadata:
+			self.metadata['total_extrusion'] = sum(l.args['E'] for l in self.lines
+				if l.code in {'G0','G1'} and l.args.get('E') is not None)
+		return self.metadata['total_extrusion']
+
+	def path_length(self):
+		"""Return the total XYZ length of all moves in this layer, starting
+		from the initial point of the layer."""
+		if 'path_length' not in self.metadata:
+			[X,Y,Z] = self.initial_point.get_coordinates()
+			path_length = 0
+			for l in self.lines:
+				if l.code in {'G0','G1'}:
+					[X0,Y0,Z0] = [X,Y,Z]
+					X = l.args.get('X', X)
+					Y = l.args.get('Y', Y)
+					Z = l.args.get('Z', Z)
+					path_length += ((X-X0)**2 + (Y-Y0)**2 + (Z-Z0)**2)**0.5
+			self.metadata['path_length'] = path_length
+		return self.metadata['path_length']
+
+	def invalidate(self, *args):
+		"""Drop cached properties depending on any of the given args, or
+		all of them if none are given."""
+		for name, depends_on in METADATA_DEPENDS_ON:
+			if not args or any(arg in depends_on for arg in args):
+				self.metadata.pop(name, None)
 
 
 	def set_preamble(self, gcodestr):
@@ -332,23 +441,126 @@ class Layer(object):
 			for arg in kwargs:
 				if arg in line.args:
 					line.args[arg] += kwargs[arg]
+		extents = self.metadata.get('extents')
+		self.invalidate(*kwargs)
+		if extents is not None: #shifting keeps the same lines at the extents
+			self.metadata['extents'] = extents
+
+	def split_adaptive(self, compensator, tolerance, max_segment_length=SEG_LENGTH_SPLIT):
+		"""Split the moves Layer() would split into SEG_LENGTH_SPLIT long
+		segments (for a layer parsed with split=False) only as finely as
+		compensator's predicted Z correction along them needs: each move is
+		split into just enough equal segments for the correction to change
+		by no more than tolerance from one segment to the next. The change
+		along a move is measured at max_segment_length intervals, so no move
+		is split into more segments than fixed length splitting would make.
+		Call before z_compensate() with the same compensator."""
+		z = self.z()
+		if z is None:
+			return
+
+		#sample the correction at the ends of the fixed length segments of
+		#each move longer than one segment, all in a single batched call
+		moves = []
+		x = []
+		y = []
+		for i, line in enumerate(self.lines):
+			if line.code in {'G0','G1'} and 'E' in line.args and\
+					line.length > max_segment_length:
+				points = [line.initial_point.get_coordinates()] +\
+					line.split_coordinates(max_segment_length)[0] +\
+					[line.final_point.get_coordinates()]
+				moves.append((i, len(x), len(points)))
+				x += [point[0]-4.195 for point in points]
+				y += [point[1]-28.195 for point in points]
+		if not moves:
+			return
+		if hasattr(compensator, 'get_predicted_errors'):
+			errors = compensator.get_predicted_errors(x, y, z)
+		else:
+			errors = [compensator.get_predicted_error(cur_x, cur_y, z)
+					for cur_x, cur_y in zip(x, y)]
+		if instrumentation:
+			instrumentation.count('compensator_calls')
+			instrumentation.count('predictions', len(x))
+
+		#replace moves from the last, so earlier indices stay valid
+		moves_split = 0
+		segments_emitted = 0
+		for i, first, n_points in reversed(moves):
+			move_errors = errors[first:first + n_points]
+			total_change = sum(abs(b - a) for a, b in zip(move_errors, move_errors[1:]))
+			n = min(int(math.ceil(total_change/tolerance)), n_points - 1)
+			if n > 1:
+				self.lines[i:i+1] = self.lines[i].split_evenly(n)
+				moves_split += 1
+				segments_emitted += n
+
+		if instrumentation:
+			instrumentation.count('moves_split', moves_split)
+			instrumentation.count('segments_emitted', segments_emitted)
+		if moves_split:
+			self.z_line = next((l for l in self.lines if 'Z' in l.args), None)
+			self.invalidate()
 
 	def z_compensate(self, compensator):
 		"""Shifts every XY move line in this layer by the amount specified by
 		compensator(). compensator is a Compensator3D instance representing
-		the error model being used for compensation."""
-		for line in self.lines:
+		the error model being used for compensation. If compensator provides
+		get_predicted_errors(), all XY moves following the line that sets
+		the layer height are evaluated in a single batched call."""
+		self.invalidate('Z')
+
+		#compensate lines up to and including the first one with a Z one at a
+		#time, as compensating that line changes self.z() for the rest
+		lines = iter(self.lines)
+		for line in lines:
+			self.z_compensate_line(line, compensator)
+			if 'Z' in line.args:
+				self.z_line = line #uniaxial traverses gain a Z, so may come first
+				break
+
+		if not hasattr(compensator, 'get_predicted_errors'):
+			for line in lines:
+				self.z_compensate_line(line, compensator)
+			return
+
+		z = self.z()
+		xy_lines = []
+		for line in lines:
 			if line.code in {'G1','G0'}:
 				if 'X' in line.args and 'Y' in line.args: #check if it is an XY move line
-					X = line.args['X']
-					Y = line.args['Y']
-					#apply z compensation with appropriate xy offset
-					line.args['Z'] = line.args['Z'] -\
-					 compensator.get_predicted_error(X-4.195,Y-28.195,self.z()) 
+					xy_lines.append(line)
 				elif 'X' in line.args or 'Y' in line.args: #uniaxial traverses
-					line.args['Z'] = self.z() #force to original layer height
-			#elif line.code == 'G0': #default G0 lines to original layer height
-				#line.args['Z'] = self.z()
+					line.args['Z'] = z #force to original layer height
+
+		#apply z compensation with appropriate xy offset
+		errors = compensator.get_predicted_errors(
+			[line.args['X']-4.195 for line in xy_lines],
+			[line.args['Y']-28.195 for line in xy_lines],
+			z)
+		if instrumentation:
+			instrumentation.count('compensator_calls')
+			instrumentation.count('predictions', len(xy_lines))
+		for line, error in zip(xy_lines, errors):
+			line.args['Z'] = line.args['Z'] - error
+
+	def z_compensate_line(self, line, compensator):
+		"""Compensate a single line of this layer, see z_compensate()."""
+		if line.code in {'G1','G0'}:
+			if 'X' in line.args and 'Y' in line.args: #check if it is an XY move line
+				X = line.args['X']
+				Y = line.args['Y']
+				#apply z compensation with appropriate xy offset
+				line.args['Z'] = line.args['Z'] -\
+				 compensator.get_predicted_error(X-4.195,Y-28.195,self.z()) 
+				if instrumentation:
+					instrumentation.count('compensator_calls')
+					instrumentation.count('predictions')
+			elif 'X' in line.args or 'Y' in line.args: #uniaxial traverses
+				line.args['Z'] = self.z() #force to original layer height
+		#elif line.code == 'G0': #default G0 lines to original layer height
+			#line.args['Z'] = self.z()
 
 	def multiply(self, **kwargs):
 		"""Same as shift but with multiplication instead."""
@@ -356,23 +568,421 @@ class Layer(object):
 			for arg in kwargs:
 				if arg in line.args:
 					line.args[arg] *= kwargs[arg]
+		self.invalidate(*kwargs)
+
+
+	def construct(self):
+		"""Construct and return a gcode string."""
+		return '\n'.join([l.construct() for l in
+				itertools.chain(self.preamble, self.lines, self.postamble)])
+
+class CompactLayer(object):
+	def __init__(self, layer):
+		"""Compact, array-backed copy of a parsed Layer. Every line is a row
+		in a set of columnar arrays: a code enum, one float column for each
+		of X, Y, Z, E and F, a bitmask of which of them are present and a
+		bitmask of which hold ints (so they are written back as ints).
+		Lines with none of these arguments are kept as raw strings, and the
+		rare lines mixing them with other arguments as Line objects."""
+		self.layernum  = layer.layernum
+		self.preamble  = [l.construct() for l in layer.preamble]
+		self.postamble = [l.construct() for l in layer.postamble]
+		self.initial_point = layer.get_initial_point()
+		self.final_point = layer.get_final_point()
+
+		self.codes    = array('B') #index into CODES, or OTHER
+		self.present  = array('B') #ARG_BITS of args present on each row
+		self.ints     = array('B') #ARG_BITS of args holding int values
+		self.columns  = dict((arg, array('d')) for arg in ARG_ORDER)
+		self.comments = array('H') #index into self.comment_table
+		self.comment_table = [None]
+		self.others   = {} #row: raw string or Line, for rows with code OTHER
+
+		comment_index = {None: 0}
+		for line in layer.lines:
+			row = len(self.codes)
+			args = line.args
+			if line.code and args and all(arg in ARG_BITS and args[arg] is not None
+					for arg in args):
+				if line.code not in CODE_INDEX:
+					CODE_INDEX[line.code] = len(CODES)
+					CODES.append(line.code)
+				self.codes.append(CODE_INDEX[line.code])
+				present = ints = 0
+				for arg in ARG_ORDER:
+					if arg in args:
+						present |= ARG_BITS[arg]
+						if not isinstance(args[arg], float):
+							ints |= ARG_BITS[arg]
+						self.columns[arg].append(args[arg])
+					else:
+						self.columns[arg].append(0)
+				self.present.append(present)
+				self.ints.append(ints)
+				if line.comment not in comment_index:
+					comment_index[line.comment] = len(self.comment_table)
+					self.comment_table.append(line.comment)
+				self.comments.append(comment_index[line.comment])
+			else:
+				self.codes.append(OTHER)
+				self.present.append(0)
+				self.ints.append(0)
+				for arg in ARG_ORDER:
+					self.columns[arg].append(0)
+				self.comments.append(0)
+				if any(arg in args for arg in ARG_BITS):
+					self.others[row] = line #may still be shifted
+				else:
+					self.others[row] = line.construct()
+
+		#cache the row setting the layer height, see Layer.metadata
+		self.z_row = next((row for row in range(0, len(self.codes))
+				if self.get(row, 'Z') is not None), None)
+		self.metadata = {}
+
+
+	def __repr__(self):
+		return '<CompactLayer %s at Z=%s; corners: (%s, %s), (%d, %d); %d lines>' % (
+				(self.layernum, self.z()) + self.extents() + (len(self.codes),))
+
+	def get_initial_point(self):
+		"""returns first XYZ coordinate point in this layer"""
+		return self.initial_point
+
+	def get_final_point(self):
+		"""returns last XYZ coordinate point in this layer"""
+		return self.final_point
+
+	def copy(self):
+		"""Return an independent copy of this layer. Only the arrays need
+		copying, which is much cheaper than copying a Layer."""
+		layer = copy.copy(self)
+		layer.preamble = list(self.preamble)
+		layer.postamble = list(self.postamble)
+		layer.codes = self.codes[:]
+		layer.present = self.present[:]
+		layer.ints = self.ints[:]
+		layer.columns = dict((arg, column[:]) for arg, column in self.columns.items())
+		layer.comments = self.comments[:]
+		layer.comment_table = list(self.comment_table)
+		layer.others = dict((row, copy.deepcopy(other) if isinstance(other, Line)
+				else other) for row, other in self.others.items())
+		layer.metadata = dict(self.metadata)
+		return layer
+
+	def get(self, row, arg):
+		"""Return the value of arg on the given row as it would appear in
+		Line.args, or None if it is not present."""
+		if self.codes[row] == OTHER:
+			other = self.others[row]
+			return other.args.get(arg) if isinstance(other, Line) else None
+		if not self.present[row] & ARG_BITS[arg]:
+			return None
+		value = self.columns[arg][row]
+		return int(value) if self.ints[row] & ARG_BITS[arg] else value
+
+	def set(self, row, arg, value):
+		"""Set the value of arg on the given row."""
+		if self.codes[row] == OTHER:
+			self.others[row].args[arg] = value
+			return
+		self.columns[arg][row] = value
+		self.present[row] |= ARG_BITS[arg]
+		if isinstance(value, float):
+			self.ints[row] &= ~ARG_BITS[arg]
+		else:
+			self.ints[row] |= ARG_BITS[arg]
 
+	def extents(self):
+		"""Return the extents of the layer: the min/max in x and y that
+		occur. Note this does not take arcs into account."""
+		#cache the rows holding the extents, see Layer.extents()
+		if 'extents' not in self.metadata:
+			x_rows = [row for row in range(0, len(self.codes))
+					if self.get(row, 'X') is not None]
+			y_rows = [row for row in range(0, len(self.codes))
+					if self.get(row, 'Y') is not None]
+			self.metadata['extents'] = (
+				min(x_rows, key=lambda row: self.get(row, 'X')),
+				min(y_rows, key=lambda row: self.get(row, 'Y')),
+				max(x_rows, key=lambda row: self.get(row, 'X')),
+				max(y_rows, key=lambda row: self.get(row, 'Y')))
+		min_x, min_y, max_x, max_y = self.metadata['extents']
+		return self.get(min_x, 'X'), self.get(min_y, 'Y'),\
+			self.get(max_x, 'X'), self.get(max_y, 'Y')
+
+	def z(self):
+		"""Return the first Z height found for this layer, see Layer.z()."""
+		if self.z_row is not None:
+			return self.get(self.z_row, 'Z')
+
+	def code(self, row):
+		"""Return the code of the given row, None for comment-only lines."""
+		if self.codes[row] == OTHER:
+			other = self.others[row]
+			return other.code if isinstance(other, Line) else None
+		return CODES[self.codes[row]]
+
+	def total_extrusion(self):
+		"""Return the sum of E over all moves in this layer."""
+		if 'total_extrusion' not in self.metadata:
+			self.metadata['total_extrusion'] = sum(self.get(row, 'E')
+				for row in range(0, len(self.codes))
+				if self.code(row) in {'G0','G1'} and self.get(row, 'E') is not None)
+		return self.metadata['total_extrusion']
+
+	def path_length(self):
+		"""Return the total XYZ length of all moves in this layer, starting
+		from the initial point of the layer."""
+		if 'path_length' not in self.metadata:
+			[X,Y,Z] = self.initial_point.get_coordinates()
+			path_length = 0
+			for row in range(0, len(self.codes)):
+				if self.code(row) in {'G0','G1'}:
+					[X0,Y0,Z0] = [X,Y,Z]
+					X = self.get(row, 'X') if self.get(row, 'X') is not None else X
+					Y = self.get(row, 'Y') if self.get(row, 'Y') is not None else Y
+					Z = self.get(row, 'Z') if self.get(row, 'Z') is not None else Z
+					path_length += ((X-X0)**2 + (Y-Y0)**2 + (Z-Z0)**2)**0.5
+			self.metadata['path_length'] = path_length
+		return self.metadata['path_length']
+
+	def invalidate(self, *args):
+		"""Drop cached properties depending on any of the given args, or
+		all of them if none are given."""
+		for name, depends_on in METADATA_DEPENDS_ON:
+			if not args or any(arg in depends_on for arg in args):
+				self.metadata.pop(name, None)
+
+	def set_preamble(self, gcodestr):
+		"""Insert lines of gcode at the beginning of the layer."""
+		self.preamble = gcodestr.split('\n')
+
+	def set_postamble(self, gcodestr):
+		"""Add lines of gcode at the end of the layer."""
+		self.postamble = gcodestr.split('\n')
+
+	def shift(self, **kwargs):
+		"""Same as Layer.shift(), for X, Y, Z, E and F only."""
+		self._apply(lambda a, b: a + b, kwargs)
+		extents = self.metadata.get('extents')
+		self.invalidate(*kwargs)
+		if extents is not None: #shifting keeps the same rows at the extents
+			self.metadata['extents'] = extents
+
+	def multiply(self, **kwargs):
+		"""Same as Layer.multiply(), for X, Y, Z, E and F only."""
+		self._apply(lambda a, b: a * b, kwargs)
+		self.invalidate(*kwargs)
+
+	def _apply(self, op, kwargs):
+		"""Apply op(value, kwargs[arg]) to every value of every given arg."""
+		for arg in kwargs:
+			if arg not in ARG_BITS:
+				raise ValueError('CompactLayer can only modify %s arguments.' %
+						', '.join(ARG_ORDER))
+		for arg, amount in kwargs.items():
+			bit = ARG_BITS[arg]
+			column = self.columns[arg]
+			keeps_int = not isinstance(amount, float)
+			for row, present in enumerate(self.present):
+				if present & bit:
+					column[row] = op(column[row], amount)
+					if not keeps_int:
+						self.ints[row] &= ~bit
+		for other in self.others.values():
+			if isinstance(other, Line):
+				for arg in kwargs:
+					if arg in other.args:
+						other.args[arg] = op(other.args[arg], kwargs[arg])
+
+	def z_compensate(self, compensator):
+		"""Same as Layer.z_compensate()."""
+		self.invalidate('Z')
+
+		#compensate rows up to and including the first one with a Z one at a
+		#time, as compensating that row changes self.z() for the rest
+		rows = iter(range(0, len(self.codes)))
+		for row in rows:
+			self._z_compensate_row(row, compensator, self.z())
+			if self.get(row, 'Z') is not None:
+				self.z_row = row #uniaxial traverses gain a Z, so may come first
+				break
+
+		z = self.z()
+		xy_rows = []
+		for row in rows:
+			if self.codes[row] == OTHER:
+				self._z_compensate_row(row, compensator, z)
+			elif CODES[self.codes[row]] in {'G1','G0'}:
+				present = self.present[row]
+				if present & XY_BITS == XY_BITS: #check if it is an XY move row
+					xy_rows.append(row)
+				elif present & XY_BITS: #uniaxial traverses
+					self.set(row, 'Z', z) #force to original layer height
+
+		#apply z compensation with appropriate xy offset
+		xs = [self.get(row, 'X')-4.195 for row in xy_rows]
+		ys = [self.get(row, 'Y')-28.195 for row in xy_rows]
+		if hasattr(compensator, 'get_predicted_errors'):
+			errors = compensator.get_predicted_errors(xs, ys, z)
+			calls = 1
+		else:
+			errors = [compensator.get_predicted_error(x, y, z) for x, y in zip(xs, ys)]
+			calls = len(xs)
+		if instrumentation:
+			instrumentation.count('compensator_calls', calls)
+			instrumentation.count('predictions', len(xs))
+		for row, error in zip(xy_rows, errors):
+			self.set(row, 'Z', self.get(row, 'Z') - error)
+
+	def _z_compensate_row(self, row, compensator, z):
+		"""Compensate a single row at layer height z, see Layer.z_compensate_line()."""
+		if self.code(row) in {'G1','G0'}:
+			X = self.get(row, 'X')
+			Y = self.get(row, 'Y')
+			if X is not None and Y is not None: #check if it is an XY move row
+				#apply z compensation with appropriate xy offset
+				self.set(row, 'Z', self.get(row, 'Z') -\
+					compensator.get_predicted_error(X-4.195,Y-28.195,z))
+				if instrumentation:
+					instrumentation.count('compensator_calls')
+					instrumentation.count('predictions')
+			elif X is not None or Y is not None: #uniaxial traverses
+				self.set(row, 'Z', z) #force to original layer height
+
+	def construct_row(self, row):
+		"""Construct and return the line of gcode for the given row."""
+		code = self.codes[row]
+		if code == OTHER:
+			other = self.others[row]
+			return other.construct() if isinstance(other, Line) else other
+		present = self.present[row]
+		ints = self.ints[row]
+		s = CODES[code]
+		for arg in ARG_ORDER:
+			bit = ARG_BITS[arg]
+			if present & bit:
+				value = self.columns[arg][row]
+				s += ARG_FORMATS[arg] % (int(value) if ints & bit else value)
+		comment = self.comment_table[self.comments[row]]
+		if comment:
+			s += ' ;' + comment
+		return s
 
 	def construct(self):
 		"""Construct and return a gcode string."""
-		return '\n'.join(l.construct() for l in self.preamble + self.lines
-				+ self.postamble)
+		return '\n'.join(self.preamble +
+				[self.construct_row(row) for row in range(0, len(self.codes))] +
+				self.postamble)
+
+class MinimalLayer(object):
+	def __init__(self, lines, layernum=None):
+		"""Layer of gcode kept as its raw lines, for compensators that only
+		shift whole layers in Z (such as compensate_z_uniform's). Only lines
+		with a Z argument are tokenized, to find the layer height and so
+		they can be rewritten; every other line is written back verbatim,
+		unsplit and without forcing explicit coordinates. Supports z(),
+		shift() and multiply() of Z, and construct()."""
+		self.layernum  = layernum
+		self.preamble  = []
+		self.postamble = []
+		self.lines = list(lines)
+		self.z_rows = [] #indices of the lines with a Z argument
+		self.z_values = [] #and their Z
+		for row, l in enumerate(self.lines):
+			if 'Z' in l:
+				args = tokenize(l)[2]
+				if args and args.get('Z') is not None:
+					self.z_rows.append(row)
+					self.z_values.append(args['Z'])
+		self.modified = False #whether the Z lines need rewriting
+
+		if instrumentation:
+			instrumentation.count('layers_parsed')
+			instrumentation.count('lines_parsed', len(self.lines))
+
+
+	def __repr__(self):
+		return '<MinimalLayer %s at Z=%s; %d lines>' % (self.layernum, self.z(),
+				len(self.lines))
+
+	def copy(self):
+		"""Return an independent copy of this layer."""
+		layer = copy.copy(self)
+		layer.preamble = list(self.preamble)
+		layer.postamble = list(self.postamble)
+		layer.z_values = list(self.z_values)
+		return layer
+
+	def z(self):
+		"""Return the first Z height found for this layer, see Layer.z()."""
+		if self.z_values:
+			return self.z_values[0]
+
+	def invalidate(self, *args):
+		"""Nothing is cached, see Layer.invalidate()."""
+		pass
+
+	def set_preamble(self, gcodestr):
+		"""Insert lines of gcode at the beginning of the layer."""
+		self.preamble = gcodestr.split('\n')
+
+	def set_postamble(self, gcodestr):
+		"""Add lines of gcode at the end of the layer."""
+		self.postamble = gcodestr.split('\n')
+
+	def shift(self, **kwargs):
+		"""Same as Layer.shift(), for Z only."""
+		self._apply(lambda value, amount: value + amount, kwargs)
+
+	def multiply(self, **kwargs):
+		"""Same as Layer.multiply(), for Z only."""
+		self._apply(lambda value, factor: value * factor, kwargs)
+
+	def _apply(self, op, kwargs):
+		"""Apply op(value, amount) to every Z in the layer."""
+		if any(arg != 'Z' for arg in kwargs):
+			raise ValueError('Unexpected argument for MinimalLayer. Only Z can be changed.')
+		if 'Z' in kwargs:
+			self.z_values = [op(value, kwargs['Z']) for value in self.z_values]
+			self.modified = True
+
+	def construct(self):
+		"""Construct and return a gcode string, rewriting the Z argument of
+		the lines holding one if they were changed."""
+		lines = self.lines
+		if self.modified:
+			lines = list(lines)
+			for row, value in zip(self.z_rows, self.z_values):
+				line = lines[row]
+				comment = ''
+				if ';' in line:
+					line, comment = line.split(';', 1)
+					comment = ';' + comment
+				lines[row] = Z_ARG.sub('Z' + str(value), line) + comment
+		return '\n'.join(itertools.chain(self.preamble, lines, self.postamble))
 
 class Gcode(object):
-	def __init__(self, filename=None, filestring=''):
+	def __init__(self, filename=None, filestring='', compact=False, split=True, minimal=False):
 		"""Parse a file's worth of gcode passed as a string. Example:
-		  g = Gcode(open('mycode.gcode').read())"""
+		  g = Gcode(open('mycode.gcode').read())
+		If compact is True, layers are stored as CompactLayers. If split is
+		False, moves are not split into SEG_LENGTH_SPLIT long segments (see
+		split_adaptive()). If minimal is True, layers (and the preamble) are
+		stored as MinimalLayers, for compensating whole layers only."""
+		if compact and minimal:
+			raise ValueError('Unexpected combination of compact and minimal.')
 		self.preamble = None
 		self.layers   = []
+		self.compact  = compact
+		self.split    = split
+		self.minimal  = minimal
 		if filename:
 			if filestring:
 				warnings.warn("Ignoring passed filestring in favor of loading file.")
-			filestring = open(filename).read()
+			with open_gcode(filename) as f:
+				filestring = f.read()
 		self.parse(filestring)
 
 
@@ -380,19 +990,86 @@ class Gcode(object):
 		return '<Gcode with %d layers>' % len(self.layers)
 
 
-	def construct(self, outfile=None):
+	def construct(self, outfile=None, modal=False, precision=None, comments=False):
 		"""Construct all and return of the gcode. If outfile is given,
-		write the gcode to the file instead of returning it."""
-		s = (self.preamble.construct() + '\n') if self.preamble else ''
+		write the gcode to the file instead of returning it. If modal is
+		True, the output is compacted by a ModalWriter, dropping arguments
+		and comments that change nothing on the printer; precision and
+		comments are passed on to it."""
+		with stage('construct'):
+			if outfile:
+				with open_gcode(outfile, 'w') as f:
+					self.write_modal(f, precision, comments) if modal else self.write(f)
+					if instrumentation:
+						instrumentation.count('bytes_written', f.tell())
+			else:
+				f = io.BytesIO()
+				self.write_modal(f, precision, comments) if modal else self.write(f)
+				if instrumentation:
+					instrumentation.count('bytes_written', f.tell())
+				return f.getvalue()
+
+	def iter_lines(self, lookahead=2, modal=False, precision=None, comments=False):
+		"""Generator yielding the lines construct() would write, without
+		line endings, as soon as each layer is constructed rather than once
+		the whole file is. A producer thread constructs up to lookahead
+		layers ahead of the lines consumed, so that a consumer such as a
+		printer sender is never kept waiting on a layer while only that
+		many are held in memory. modal, precision and comments are as for
+		construct(). Closing the generator early stops the producer."""
+		queue = PipelineQueue('lines', lookahead)
+		f = LayerQueueFile(queue)
+		def produce():
+			try:
+				self.write_modal(f, precision, comments) if modal else self.write(f)
+				f.flush()
+			except Exception:
+				if not f.stopped.is_set():
+					queue.error = sys.exc_info()
+			queue.put(PIPELINE_END)
+		producer = threading.Thread(target=produce, name='gcode lines')
+		producer.daemon = True
+		producer.start()
+		try:
+			partial = ''
+			for chunk in queue:
+				lines = (partial + chunk).split('\n')
+				partial = lines.pop()
+				for l in lines:
+					yield l
+			if partial:
+				yield partial
+		finally:
+			f.stopped.set()
+			while producer.is_alive():
+				queue.drain()
+				producer.join(0.01)
+
+	def write_modal(self, f, precision=None, comments=False):
+		"""Same as write(), compacting the gcode with a ModalWriter."""
+		writer = ModalWriter(f, precision, comments)
+		self.write(writer)
+		writer.flush()
+		if instrumentation:
+			instrumentation.count('lines_dropped', writer.lines_in - writer.lines_out)
+
+	def write(self, f):
+		"""Write all of the gcode to the file object f, one layer at a
+		time."""
+		if self.preamble:
+			f.write(self.preamble.construct() + '\n')
 		for i,layer in enumerate(self.layers):
-			s += ';LAYER:%d\n' % i
-			s += layer.construct()
-			s += '\n'
-		if outfile:
-			with open(outfile, 'w') as f:
-				f.write(s)
-		else:
-			return s
+			f.write(';LAYER:%d\n' % i)
+			f.write(layer.construct())
+			f.write('\n')
+
+	def copy(self):
+		"""Return a copy of this gcode whose layers can be modified
+		independently of the original's, without parsing it again."""
+		g = copy.copy(self)
+		g.preamble = self.preamble.copy() if self.preamble else None
+		g.layers = [layer.copy() for layer in self.layers]
+		return g
 
 	def shift(self, layernum=0, **kwargs):
 		"""Shift given layer and all following. Provide arguments and
@@ -413,68 +1090,1366 @@ class Gcode(object):
 		for layer in self.layers[layernum:]:
 			layer.multiply(**kwargs)
 
+	def split_adaptive(self, compensator, tolerance):
+		"""Split the moves of gcode parsed with split=False where the Z
+		correction predicted by compensator changes by more than tolerance
+		along them, see Layer.split_adaptive(). The first layer is left
+		unsplit, as z_compensate() does not compensate it."""
+		for layer in self.layers[1:]:
+			layer.split_adaptive(compensator, tolerance)
+
+	def pack(self, filename, source_hash=None):
+		"""Save the parsed gcode to filename in a binary format that
+		PackedGcode can reload without parsing it again. Each layer's
+		CompactLayer arrays are written out as they are, followed by a
+		pickled index holding the position of each layer's arrays and a
+		table of the distinct comments and non-move lines (the preamble's
+		included), which each layer refers to by index. The index holds
+		only plain data (lines as strings, points as coordinates), so the
+		format does not depend on the classes of this module. source_hash,
+		if given, is stored to tell which gcode file was packed, see
+		file_hash()."""
+		strings = []
+		string_index = {}
+		def intern(s):
+			if s not in string_index:
+				string_index[s] = len(strings)
+				strings.append(s)
+			return string_index[s]
+
+		layers = []
+		with open(filename, 'wb', WRITE_BUFFER_SIZE) as f:
+			f.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, 0))
+			for layer in self.layers:
+				if not isinstance(layer, CompactLayer):
+					layer = CompactLayer(layer)
+				offset = f.tell()
+				for name, typecode in PACK_COLUMNS:
+					column = layer.columns[name] if name in ARG_BITS else getattr(layer, name)
+					f.write(column.tostring())
+				layers.append((layer.layernum, layer.initial_point.get_coordinates(),
+					layer.final_point.get_coordinates(), len(layer.codes), offset,
+					layer.z_row, layer.preamble, layer.postamble,
+					[intern(comment) for comment in layer.comment_table],
+					dict((row, (intern(other.construct()), True) if isinstance(other, Line)
+						else (intern(other), False)) for row, other in layer.others.items())))
+
+			index_offset = f.tell()
+			cPickle.dump({
+				'byteorder': sys.byteorder,
+				'arg_order': ARG_ORDER,
+				'codes': CODES,
+				'source_hash': source_hash,
+				'preamble': [intern(source_line(l)) for l in self.preamble.lines]
+					if self.preamble else [],
+				'strings': strings,
+				'layers': layers,
+				}, f, cPickle.HIGHEST_PROTOCOL)
+			f.seek(0)
+			f.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, index_offset))
+
 	def parse(self, filestring):
 		"""Parse the gcode."""
 		if not filestring:
 			return
 
-		in_preamble = True
-		in_raft = True
+		with stage('parse'):
+			if self.minimal:
+				layers = iter_minimal_layers(filestring.split('\n'))
+			else:
+				layers = iter_layers(filestring.split('\n'), self.split)
+			self.preamble = next(layers)
+			if self.compact:
+				self.layers = [CompactLayer(layer) for layer in layers]
+			else:
+				self.layers = list(layers)
+
+class GcodeStream(Gcode):
+	def __init__(self, filename, split=True, minimal=False):
+		"""Streaming counterpart of Gcode: layers are parsed lazily from
+		the file as they are consumed, so only one layer is held in memory
+		at a time. The preamble is parsed up front. Example:
+		  g = GcodeStream('in.gcode')
+		  g.z_compensate(compensator)
+		  g.construct('out.gcode')"""
+		if minimal:
+			self.layers = iter_minimal_layers(read_lines(filename))
+		else:
+			self.layers = iter_layers(read_lines(filename), split)
+		self.preamble = next(self.layers)
+
+
+	def __repr__(self):
+		return '<GcodeStream>'
+
+
+	def map(self, func):
+		"""Lazily apply func to every layer as it is parsed. func takes
+		the layer index and the Layer and modifies the Layer in place."""
+		self.layers = (func(i, layer) or layer for i,layer in
+				enumerate(self.layers))
+
+
+	def z_compensate(self, compensator):
+		"""Same as Gcode.z_compensate(), applied lazily as layers stream
+		through."""
+		self.map(lambda i, layer: layer.z_compensate(compensator) if i > 0
+				else None)
+
+
+	def split_adaptive(self, compensator, tolerance):
+		"""Same as Gcode.split_adaptive(), applied lazily as layers stream
+		through."""
+		self.map(lambda i, layer: layer.split_adaptive(compensator, tolerance)
+				if i > 0 else None)
+
+
+	def shift(self, layernum=0, **kwargs):
+		"""Same as Gcode.shift(), applied lazily as layers stream
+		through."""
+		self.map(lambda i, layer: layer.shift(**kwargs) if i >= layernum
+				else None)
+
+
+	def multiply(self, layernum=0, **kwargs):
+		"""Same as Gcode.multiply(), applied lazily as layers stream
+		through."""
+		self.map(lambda i, layer: layer.multiply(**kwargs) if i >= layernum
+				else None)
+
+class GcodePipeline(GcodeStream):
+	def __init__(self, filename, split=True, minimal=False, queue_size=16):
+		"""Pipelined counterpart of GcodeStream: a reader thread reads the
+		file and splits it into layers, the layers are parsed, operated on
+		and constructed by the thread consuming them, and a writer thread
+		writes them out, so reading and writing (and any compression, see
+		open_gcode()) overlap with the work in between. Layers are passed
+		between stages through PipelineQueues of queue_size layers each, so
+		a stage that gets ahead blocks rather than buffering the file. After
+		construct(), report() gives each queue's depth and the time spent
+		waiting on it. Output is identical to GcodeStream."""
+		self.queues = collections.OrderedDict([
+			('read', PipelineQueue('read', queue_size)),
+			('write', PipelineQueue('write', queue_size))])
+		self.stopped = threading.Event()
+		self.reader = threading.Thread(target=self.read_layers, args=(filename,),
+				name='gcode reader')
+		self.reader.daemon = True
+		self.reader.start()
+		if minimal:
+			self.layers = parse_minimal_layers(self.queues['read'])
+		else:
+			self.layers = parse_layers(self.queues['read'], split)
+		self.preamble = next(self.layers)
+
+
+	def __repr__(self):
+		return '<GcodePipeline>'
+
+
+	def read_layers(self, filename):
+		"""Reader thread: put the lines of each layer of the file on the
+		read queue, until the end of the file or close()."""
+		queue = self.queues['read']
+		try:
+			for layer_lines in iter_layer_lines(read_lines(filename)):
+				queue.put(layer_lines)
+				if self.stopped.is_set():
+					return
+		except Exception:
+			queue.error = sys.exc_info()
+		queue.put(PIPELINE_END)
+
+
+	def write_chunks(self, f):
+		"""Writer thread: write the constructed layers on the write queue
+		to the file object f. After an error, the rest are discarded."""
+		queue = self.queues['write']
+		for chunk in iter(queue.get, PIPELINE_END):
+			if queue.error is None:
+				try:
+					f.write(chunk)
+				except Exception:
+					queue.error = sys.exc_info()
+
+
+	def write(self, f):
+		"""Same as Gcode.write(), with the layers written to f by a writer
+		thread while the next ones are constructed."""
+		queue = self.queues['write']
+		writer = threading.Thread(target=self.write_chunks, args=(f,), name='gcode writer')
+		writer.daemon = True
+		writer.start()
+		try:
+			if self.preamble:
+				queue.put(self.preamble.construct() + '\n')
+			for i,layer in enumerate(self.layers):
+				if queue.error is not None:
+					break
+				queue.put(';LAYER:%d\n%s\n' % (i, layer.construct()))
+		finally:
+			queue.put(PIPELINE_END)
+			writer.join()
+			self.close()
+		if queue.error is not None:
+			raise queue.error[0], queue.error[1], queue.error[2]
+		if instrumentation:
+			for name, stats in self.report().items():
+				instrumentation.count('%s_queue_max_depth' % name, stats['max_depth'])
+				for key in ('put_wait', 'get_wait'): #seconds, so timed as stages
+					instrumentation.add_time('%s_queue_%s' % (name, key), stats[key])
+
+
+	def close(self):
+		"""Stop the reader thread, if it has not reached the end of the
+		file, and wait for it to exit."""
+		self.stopped.set()
+		while self.reader.is_alive():
+			self.queues['read'].drain()
+			self.reader.join(0.01)
+
+
+	def report(self):
+		"""Return each queue's statistics by name, see PipelineQueue.report().
+		A stage waiting to put is held up by the stages after it, one waiting
+		to get by the stages before it."""
+		return collections.OrderedDict((name, queue.report())
+				for name, queue in self.queues.items())
+
+PIPELINE_END = object() #put on a PipelineQueue after the last item
+
+class PipelineQueue(object):
+	def __init__(self, name, maxsize):
+		"""Bounded queue of items (layers) passed from one GcodePipeline
+		stage to the next, keeping statistics on its depth and on the time
+		each side spent blocked. Iterating over it gets items until
+		PIPELINE_END, then raises any error the producer set on it."""
+		self.name = name
+		self.queue = Queue.Queue(maxsize)
+		self.error = None #sys.exc_info() of a failed stage
+		self.items = 0
+		self.total_depth = 0
+		self.max_depth = 0
+		self.put_wait = 0.0 #seconds the producer waited for room
+		self.get_wait = 0.0 #seconds the consumer waited for items
+
+	def __repr__(self):
+		return '<PipelineQueue %s with %d items>' % (self.name, self.queue.qsize())
+
+	def __iter__(self):
+		while True:
+			item = self.get()
+			if item is PIPELINE_END:
+				break
+			yield item
+		if self.error is not None:
+			raise self.error[0], self.error[1], self.error[2]
+
+	def put(self, item):
+		depth = self.queue.qsize()
+		if item is not PIPELINE_END:
+			self.items += 1
+			self.total_depth += depth
+			self.max_depth = max(self.max_depth, depth)
+		if depth < self.queue.maxsize:
+			self.queue.put(item)
+		else:
+			start = time.time()
+			self.queue.put(item)
+			self.put_wait += time.time() - start
+
+	def get(self):
+		try:
+			return self.queue.get_nowait()
+		except Queue.Empty:
+			start = time.time()
+			item = self.queue.get()
+			self.get_wait += time.time() - start
+			return item
+
+	def drain(self):
+		"""Discard any items waiting, unblocking the producer."""
+		try:
+			while True:
+				self.queue.get_nowait()
+		except Queue.Empty:
+			pass
+
+	def report(self):
+		"""Return a dict of the number of items passed, their mean and
+		maximum queue depth when put, and the seconds spent waiting to put
+		and to get."""
+		return {
+			'items': self.items,
+			'mean_depth': float(self.total_depth)/self.items if self.items else 0.0,
+			'max_depth': self.max_depth,
+			'put_wait': self.put_wait,
+			'get_wait': self.get_wait,
+			}
+
+class LayerQueueFile(object):
+	def __init__(self, queue):
+		"""File object putting what is written to it on a PipelineQueue
+		one layer at a time, see Gcode.iter_lines(). A layer ends where the
+		next one's LAYER comment is written, or at flush(). Writing raises
+		IOError once stopped is set."""
+		self.queue = queue
+		self.chunks = []
+		self.stopped = threading.Event()
+
+	def write(self, s):
+		if self.stopped.is_set():
+			raise IOError('Unexpected write after the lines were closed.')
+		s = str(s)
+		if self.chunks and s.startswith(';LAYER:'):
+			self.flush()
+		self.chunks.append(s)
+
+	def flush(self):
+		if self.chunks:
+			self.queue.put(''.join(self.chunks))
+			self.chunks = []
+
+class GcodeParallel(Gcode):
+	def __init__(self, filename, processes=None, chunk_size=8):
+		"""Parallel counterpart of Gcode. Only a light pass is made over the
+		file up front, finding the layer boundaries, the point each layer
+		starts from and its nominal Z. Operations on the layers are recorded
+		by LayerTask placeholders, and carried out by a pool of processes
+		(processes defaults to the number of CPUs) each parsing, compensating
+		and constructing chunk_size layers at a time. Output is identical to
+		Gcode."""
+		self.processes = processes
+		self.chunk_size = chunk_size
+		layer_lines = iter_layer_lines(read_lines(filename))
+		self.preamble = make_preamble(next(layer_lines))
+		self.layers = []
+		prev_final_pt = self.preamble.get_final_point() if self.preamble \
+			else Point(0,0,0)
+		for layernum, lines in enumerate(layer_lines, 1):
+			layer = LayerTask(prev_final_pt, lines, layernum=layernum)
+			prev_final_pt = layer.get_final_point()
+			self.layers.append(layer)
+
+
+	def __repr__(self):
+		return '<GcodeParallel with %d layers>' % len(self.layers)
+
+
+	def write(self, f):
+		"""Construct all of the gcode in parallel and write it to the file
+		object f, see Gcode.write()."""
+		chunks = ([(i, layer.get_initial_point().get_coordinates(), layer.lines,
+					layer.layernum, layer.operations)
+				   for i, layer in enumerate(self.layers[start:start+self.chunk_size],
+					   start)]
+				  for start in range(0, len(self.layers), self.chunk_size))
+		pool = multiprocessing.Pool(self.processes)
+		try:
+			if self.preamble:
+				f.write(self.preamble.construct() + '\n')
+			for constructed_chunk in pool.imap(construct_layer_tasks, chunks):
+				f.write(constructed_chunk)
+		finally:
+			pool.close()
+			pool.join()
+
+def construct_layer_tasks(tasks):
+	"""Worker for GcodeParallel.construct(): parse each layer from its
+	lines and initial point, apply the recorded operations and return the
+	constructed gcode for all of them."""
+	f = io.BytesIO()
+	for i, initial_point, lines, layernum, operations in tasks:
+		layer = Layer(Point(*initial_point), lines, layernum=layernum)
+		for name, args, kwargs in operations:
+			getattr(layer, name)(*args, **kwargs)
+		f.write(';LAYER:%d\n' % i)
+		f.write(layer.construct())
+		f.write('\n')
+	return f.getvalue()
+
+class LayerTask(object):
+	def __init__(self, prev_layer_final_pt, lines, layernum=None):
+		"""Placeholder for a Layer to be parsed later by GcodeParallel. Only
+		the layer's final point and the Z that Layer.z() would return are
+		found now; shift(), multiply() and z_compensate() are recorded in
+		self.operations to be applied once the layer is parsed. Compensators
+		must therefore be picklable."""
+		self.layernum = layernum
+		self.lines = lines
+		self.initial_point = prev_layer_final_pt
+		self.operations = []
+		self.nominal_z, self.final_point = scan_layer_lines(prev_layer_final_pt, lines)
+
+	def __repr__(self):
+		return '<LayerTask %s; %d lines, %d operations>' % (
+				self.layernum, len(self.lines), len(self.operations))
+
+	def get_initial_point(self):
+		"""returns first XYZ coordinate point in this layer"""
+		return self.initial_point
+
+	def get_final_point(self):
+		"""returns last XYZ coordinate point in this layer"""
+		return self.final_point
+
+	def z(self):
+		"""Return the Z height Layer.z() would return once the recorded
+		operations are applied."""
+		z = self.nominal_z
+		if z is None:
+			return None
+		for name, args, kwargs in self.operations:
+			if name == 'shift' and 'Z' in kwargs:
+				z += kwargs['Z']
+			elif name == 'multiply' and 'Z' in kwargs:
+				z *= kwargs['Z']
+			elif name == 'z_compensate':
+				raise ValueError('Z height of a layer is not known until it has been compensated.')
+		return z
+
+	def shift(self, **kwargs):
+		"""Record a Layer.shift()."""
+		self.operations.append(('shift', (), kwargs))
+
+	def multiply(self, **kwargs):
+		"""Record a Layer.multiply()."""
+		self.operations.append(('multiply', (), kwargs))
+
+	def z_compensate(self, compensator):
+		"""Record a Layer.z_compensate()."""
+		self.operations.append(('z_compensate', (compensator,), {}))
+
+def scan_layer_lines(prev_layer_final_pt, lines):
+	"""Light pass over the lines of a layer, tokenizing only as many as
+	needed rather than parsing them: from the start up to the line setting
+	the layer height, and from the end back to the last X, Y and Z moved
+	to. Returns the Z that Layer.z() would return for the parsed layer
+	(None if it has none) and the layer's final point."""
+	[X,Y,Z] = prev_layer_final_pt.get_coordinates()
+	nominal_z = None
+	for i, l in enumerate(lines):
+		code, args = tokenize(l)[1:3]
+		if not code:
+			continue
+		is_move = code in {'G0','G1'}
+		is_e_only = not ('X' in args or 'Y' in args or 'Z' in args) and 'E' in args
+		if 'Z' in args or (is_move and not is_e_only):
+			#parse the line setting the layer height for real, as it may be split;
+			# no earlier line moved, so it starts from the previous layer's final point
+			line = Line(l, Point(X,Y,Z), explicit=True)
+			if is_move and (i == 0 or 'E' in line.args):
+				line = line.split_move(SEG_LENGTH_SPLIT)[0]
+			nominal_z = line.args['Z']
+			break
+
+	final = {}
+	for l in reversed(lines):
+		if not any(axis in l for axis in 'XYZ' if not axis in final):
+			continue #cannot set any axis still missing
+		code, args = tokenize(l)[1:3]
+		if not code in ('G0','G1'):
+			continue
+		if not ('X' in args or 'Y' in args or 'Z' in args):
+			continue #E only, or no move at all
+		for axis in 'XYZ':
+			if axis in args and not axis in final:
+				final[axis] = float(args[axis])
+		if len(final) == 3:
+			break
+	return nominal_z, Point(final.get('X', X), final.get('Y', Y), final.get('Z', Z))
+
+class PackedGcode(Gcode):
+	def __init__(self, filename):
+		"""Gcode reloaded from a file written by Gcode.pack(), without any
+		parsing. The file is memory-mapped and only its index is read up
+		front; each layer's arrays are copied out of the mapping into a
+		CompactLayer the first time that layer is used. Example:
+		  Gcode('in.gcode', compact=True).pack('in.gcpk')
+		  g = PackedGcode('in.gcpk')
+		  g.z_compensate(compensator)
+		  g.construct('out.gcode')"""
+		with open(filename, 'rb') as f:
+			self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			index = self.load_index()
+			self.compact = True
+			self.source_hash = index['source_hash']
+			self.strings = index['strings']
+			self.preamble = make_preamble([self.strings[i] for i in index['preamble']])
+		except ValueError:
+			self.close()
+			raise
+		except Exception:
+			#truncated or corrupt index: EOFError, UnpicklingError, KeyError...
+			self.close()
+			raise ValueError('Unexpected contents in packed gcode file. Expecting packed gcode.')
+		self.swap = index['byteorder'] != sys.byteorder
+
+		#map the file's code enum onto ours, if they differ
+		for code in index['codes']:
+			if code not in CODE_INDEX:
+				CODE_INDEX[code] = len(CODES)
+				CODES.append(code)
+		self.code_table = None
+		if index['codes'] != CODES[:len(index['codes'])]:
+			table = [chr(i) for i in range(0, 256)]
+			for i, code in enumerate(index['codes']):
+				table[i] = chr(CODE_INDEX[code])
+			self.code_table = ''.join(table)
+
+		self.layers = PackedLayers(self, index['layers'])
+
+
+	def __repr__(self):
+		return '<PackedGcode with %d layers>' % len(self.layers)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def close(self):
+		"""Unmap the file, so it can be replaced. Layers not unpacked yet
+		can no longer be used."""
+		self.mapping.close()
+
+	def load_index(self):
+		"""Check the header and return the unpickled index. Only plain data
+		is unpickled: a pickle naming any class or function is rejected
+		rather than run."""
+		if len(self.mapping) < PACK_HEADER.size:
+			raise ValueError('Unexpected file type for packed gcode file. Expecting packed gcode.')
+		magic, version, index_offset = PACK_HEADER.unpack_from(self.mapping)
+		if magic != PACK_MAGIC:
+			raise ValueError('Unexpected file type for packed gcode file. Expecting packed gcode.')
+		elif version != PACK_VERSION:
+			raise ValueError('Unexpected packed gcode version %d. Expecting %d.' %
+					(version, PACK_VERSION))
+		index = loads_plain(self.mapping[index_offset:])
+		if index['arg_order'] != ARG_ORDER:
+			raise ValueError('Packed gcode was written with a different argument order.')
+		return index
+
+
+	def unpack_layer(self, entry):
+		"""Return the CompactLayer for an entry of the index."""
+		layer = CompactLayer.__new__(CompactLayer)
+		(layer.layernum, initial_point, final_point, rows, offset,
+			layer.z_row, layer.preamble, layer.postamble, comment_table, others) = entry
+		layer.initial_point = Point(*initial_point)
+		layer.final_point = Point(*final_point)
+		layer.columns = {}
+		for name, typecode in PACK_COLUMNS:
+			column = array(typecode)
+			size = rows * column.itemsize
+			if name == 'codes' and self.code_table:
+				column.fromstring(self.mapping[offset:offset+size].translate(self.code_table))
+			else:
+				column.fromstring(buffer(self.mapping, offset, size))
+			if self.swap:
+				column.byteswap()
+			offset += size
+			if name in ARG_BITS:
+				layer.columns[name] = column
+			else:
+				setattr(layer, name, column)
+		layer.comment_table = [self.strings[i] for i in comment_table]
+		layer.others = dict((row, Line(self.strings[i], layer.initial_point) if parse
+				else self.strings[i]) for row, (i, parse) in others.items())
+		layer.metadata = {}
+		return layer
+
+class PackedLayers(object):
+	def __init__(self, gcode, entries):
+		"""Sequence of the layers of a PackedGcode, unpacking each layer the
+		first time it is accessed and keeping it from then on, so changes
+		made to it stick."""
+		self.gcode = gcode
+		self.entries = entries
+		self.unpacked = {}
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
+		if i < 0:
+			i += len(self)
+		if i not in self.unpacked:
+			self.unpacked[i] = self.gcode.unpack_layer(self.entries[i])
+		return self.unpacked[i]
+
+	def __iter__(self):
+		for i in range(0, len(self)):
+			yield self[i]
+
+class LayerIndex(object):
+	def __init__(self, filename):
+		"""Index of where each layer of a gcode file starts and ends, built
+		in one pass without parsing the file. self.layers[i] describes
+		Gcode(filename).layers[i] as a tuple of
+		  (start, body, end, initial point, nominal Z)
+		where start to end are the layer's byte offsets in the file, body
+		is where its lines start (after Cura's LAYER comment, if any) and
+		nominal Z is what the parsed layer's z() would return."""
+		if compression(filename):
+			raise ValueError('Unexpected compressed file. Byte offsets need an uncompressed .gcode file.')
+		self.filename = filename
+		self.layers = []
+
+		position = [0, 0] #byte offsets of the start and end of the current line
+		def lines(f):
+			for l in f:
+				position[0] = position[1]
+				position[1] += len(l)
+				yield l[:-1] if l.endswith('\n') else l
+
+		layer = None #[start, body, lines] of the layer being read
+		prev_final_pt = Point(0,0,0)
+		preamble = []
+		with open(filename, 'rb') as f:
+			for l, starts_layer in iter_layer_breaks(lines(f)):
+				if starts_layer:
+					if layer is None or layer[2]:
+						prev_final_pt = self.add_layer(layer, position[0], prev_final_pt, preamble)
+						layer = [position[0], position[0], []]
+					if CURA_LAYER.match(l):
+						layer[1] = position[1] #Cura's LAYER comments are dropped
+					else:
+						layer[2].append(l)
+				elif l:
+					(preamble if layer is None else layer[2]).append(l)
+			self.add_layer(layer, position[1], prev_final_pt, preamble)
+
+
+	def __repr__(self):
+		return '<LayerIndex of %s with %d layers>' % (self.filename, len(self.layers))
+
+
+	def add_layer(self, layer, end, prev_final_pt, preamble):
+		"""Add the layer ending at byte offset end to the index, or nothing
+		if layer is None (the preamble). Returns the layer's final point."""
+		if layer is None:
+			return scan_layer_lines(prev_final_pt, preamble)[1]
+		(start, body, lines) = layer
+		if not lines:
+			return prev_final_pt
+		nominal_z, final_point = scan_layer_lines(prev_final_pt, lines)
+		self.layers.append((start, body, end, prev_final_pt, nominal_z))
+		return final_point
+
+	def layer_range(self, min_height=None, max_height=None):
+		"""Return (start, stop) such that layers[start:stop] spans the layers
+		whose nominal Z is above min_height and at or below max_height
+		(either may be None for no limit). start == stop == len(layers) if
+		there are none."""
+		selected = [i for i, layer in enumerate(self.layers) if layer[4] is not None and
+				(min_height is None or layer[4] > min_height) and
+				(max_height is None or layer[4] <= max_height)]
+		if not selected:
+			return len(self.layers), len(self.layers)
+		return selected[0], selected[-1] + 1
+
+class GcodeRange(Gcode):
+	def __init__(self, filename, start=0, stop=None, index=None, compact=False,
+			minimal_prefix=False):
+		"""Gcode holding only the layers start up to (not including) stop of
+		a file, numbered as in Gcode.layers (stop defaults to the end of the
+		file). Only those layers are parsed, found with index (a LayerIndex
+		of the file, built if not given). Writing copies the rest of the
+		file, preamble included, unchanged as raw bytes around the layers.
+		If minimal_prefix is True, the layers before the range are instead
+		read as MinimalLayers into self.prefix_layers, so that they can be
+		shifted in Z too (needed when, as with compensate_z_uniform, the
+		shifts of earlier layers carry forward into later ones).
+		Layer numbers passed to shift() and multiply() count from the start
+		of the file, not of the range. Example, to recompensate from
+		layer 700 up:
+		  g = GcodeRange('in.gcode', 700)
+		  g.z_compensate(compensator)
+		  g.construct('out.gcode')"""
+		self.filename = filename
+		self.index = index if index else LayerIndex(filename)
+		self.compact = compact
+		self.preamble = None
+		(self.start, self.stop, step) = slice(start, stop).indices(len(self.index.layers))
+		self.stop = max(self.start, self.stop)
+		with open(filename, 'rb') as f:
+			self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		self.layers = []
+		for layernum in range(self.start, self.stop):
+			(start, body, end, initial_point, nominal_z) = self.index.layers[layernum]
+			lines = [l for l in self.mapping[body:end].split('\n') if l]
+			layer = Layer(initial_point, lines, layernum=layernum+1)
+			self.layers.append(CompactLayer(layer) if compact else layer)
+
+		self.prefix_layers = []
+		if minimal_prefix:
+			for layernum in range(0, self.start):
+				(start, body, end) = self.index.layers[layernum][0:3]
+				lines = [l for l in self.mapping[body:end].split('\n') if l]
+				self.prefix_layers.append(MinimalLayer(lines, layernum=layernum+1))
+
+
+	def __repr__(self):
+		return '<GcodeRange with layers %d to %d of %d>' % (self.start, self.stop,
+				len(self.index.layers))
+
+
+	def construct(self, outfile=None, modal=False, precision=None, comments=False):
+		"""Same as Gcode.construct(), which must not overwrite the file the
+		layers were read from."""
+		if outfile and os.path.exists(outfile) and \
+				os.path.samefile(outfile, self.filename):
+			raise ValueError('Cannot write a GcodeRange over the file it was read from.')
+		return Gcode.construct(self, outfile, modal, precision, comments)
+
+	def write(self, f):
+		"""Write the file to the file object f, with the layers in the range
+		constructed and everything else copied as it was."""
+		if not (self.layers or self.prefix_layers):
+			f.write(buffer(self.mapping))
+			return
+		prefix_end = self.index.layers[0 if self.prefix_layers else self.start][0]
+		f.write(buffer(self.mapping, 0, prefix_end))
+		for layernum, layer in enumerate(self.prefix_layers + self.layers,
+				self.start - len(self.prefix_layers)):
+			(start, body) = self.index.layers[layernum][0:2]
+			f.write(buffer(self.mapping, start, body - start)) #Cura's LAYER comment
+			f.write(layer.construct())
+			f.write('\n')
+		suffix_start = self.index.layers[self.stop-1][2]
+		f.write(buffer(self.mapping, suffix_start))
+
+	def shift(self, layernum=0, **kwargs):
+		"""Same as Gcode.shift(), with layernum counted from the start of the
+		file. Layers before the range are shifted too if they were read, see
+		minimal_prefix."""
+		for layer in self.prefix_layers[layernum:] + self.layers[max(layernum - self.start, 0):]:
+			layer.shift(**kwargs)
+
+	def z_compensate(self, compensator):
+		"""Same as Gcode.z_compensate(), for the layers in the range."""
+		for layer in self.layers[1 if self.start == 0 else 0:]:
+			layer.z_compensate(compensator)
+
+	def multiply(self, layernum=0, **kwargs):
+		"""Same as Gcode.multiply(), with layernum counted from the start of
+		the file, see shift()."""
+		for layer in self.prefix_layers[layernum:] + self.layers[max(layernum - self.start, 0):]:
+			layer.multiply(**kwargs)
+
+def construct_incremental(filename, outfile, layer_keys, apply, index=None):
+	"""Write the gcode in filename to outfile, with apply(i, layer) called
+	on every layer first, exactly as parsing it with Gcode, applying apply
+	to each of Gcode.layers and calling construct(outfile) would. A small
+	cache saved next to outfile records what layer_keys were used for each
+	layer; layer_keys[i] must capture everything apply() does to layer i.
+	When run again over the same file contents, every layer whose key is
+	unchanged is copied from the previous outfile as it is, and only the
+	other layers are parsed. index is a LayerIndex of filename, built if not
+	given. Returns the list of layer numbers that were recomputed."""
+	if compression(outfile):
+		raise ValueError('Unexpected compressed outfile. Copying layers needs an uncompressed .gcode file.')
+	index = index if index else LayerIndex(filename)
+	if len(layer_keys) != len(index.layers):
+		raise ValueError('Expecting one key per layer, got %d keys for %d layers.' %
+				(len(layer_keys), len(index.layers)))
+	cache_filename = outfile + CACHE_SUFFIX
+	source_hash = file_hash(filename)
+
+	#load the previous run's cache if it is for the same file and its output is untouched
+	cache = {'keys': [], 'offsets': []}
+	previous = None
+	try:
+		with open(cache_filename, 'rb') as f:
+			saved = loads_plain(f.read())
+		stat = os.stat(outfile)
+		if saved['source_hash'] == source_hash and\
+				saved['seg_length_split'] == SEG_LENGTH_SPLIT and\
+				saved['output_stat'] == (stat.st_size, stat.st_mtime) and stat.st_size and\
+				len(saved['offsets']) == len(saved['keys']) and\
+				all(0 <= start <= end <= stat.st_size for start, end in saved['offsets']):
+			cache = saved
+			with open(outfile, 'rb') as f:
+				previous = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	except Exception:
+		#missing, truncated, corrupt or foreign: no usable cache, recompute everything
+		cache = {'keys': [], 'offsets': []}
+
+	recomputed = []
+	offsets = []
+	with open(filename, 'rb') as f:
+		mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		with open(outfile + '.tmp', 'wb', WRITE_BUFFER_SIZE) as f:
+			preamble_end = index.layers[0][0] if index.layers else len(mapping)
+			preamble = make_preamble([l for l in mapping[0:preamble_end].split('\n') if l])
+			if preamble:
+				f.write(preamble.construct() + '\n')
+			for i, key in enumerate(layer_keys):
+				start = f.tell()
+				if i < len(cache['keys']) and cache['keys'][i] == key:
+					(cached_start, cached_end) = cache['offsets'][i]
+					f.write(buffer(previous, cached_start, cached_end - cached_start))
+				else:
+					(body, end, initial_point) = index.layers[i][1:4]
+					layer = Layer(initial_point,
+							[l for l in mapping[body:end].split('\n') if l], layernum=i+1)
+					apply(i, layer)
+					f.write(';LAYER:%d\n' % i)
+					f.write(layer.construct())
+					f.write('\n')
+					recomputed.append(i)
+				offsets.append((start, f.tell()))
+			if instrumentation:
+				instrumentation.count('layers_reused', len(layer_keys) - len(recomputed))
+				instrumentation.count('bytes_written', f.tell())
+	finally:
+		mapping.close()
+		if previous:
+			previous.close()
+
+	if os.path.exists(outfile):
+		os.remove(outfile) #os.rename() does not replace files on Windows
+	os.rename(outfile + '.tmp', outfile)
+	stat = os.stat(outfile)
+	with open(cache_filename, 'wb') as f:
+		cPickle.dump({
+			'source_hash': source_hash,
+			'seg_length_split': SEG_LENGTH_SPLIT,
+			'output_stat': (stat.st_size, stat.st_mtime),
+			'keys': list(layer_keys),
+			'offsets': offsets,
+			}, f, cPickle.HIGHEST_PROTOCOL)
+	return recomputed
+
+def loads_plain(data):
+	"""Unpickle data holding only plain data (numbers, strings, tuples,
+	lists, dicts...). A pickle naming any class or function raises
+	cPickle.UnpicklingError rather than having it looked up and run."""
+	unpickler = cPickle.Unpickler(io.BytesIO(data))
+	unpickler.find_global = None
+	return unpickler.load()
+
+def file_hash(filename):
+	"""Return the SHA-1 hex digest of a file's contents."""
+	h = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(WRITE_BUFFER_SIZE), ''):
+			h.update(chunk)
+	return h.hexdigest()
+
+def parse_packed(filename, pack_filename=None):
+	"""Return the parsed gcode in filename, reloaded from pack_filename
+	(defaults to filename with a .gcpk extension) if that was packed from
+	the same file contents. Otherwise the file is parsed with compact
+	layers and packed to pack_filename for next time."""
+	if pack_filename is None:
+		pack_filename = os.path.splitext(filename)[0] + '.gcpk'
+	source_hash = file_hash(filename)
+	if os.path.exists(pack_filename):
+		try:
+			g = PackedGcode(pack_filename)
+		except (ValueError, EnvironmentError):
+			pass #unreadable, corrupt or outdated format, repack it
+		else:
+			if g.source_hash == source_hash:
+				return g
+			g.close() #stale, unmap it before it is replaced
+	g = Gcode(filename, compact=True)
+	g.pack(pack_filename, source_hash)
+	return g
+
+class Instrumentation(object):
+	def __init__(self, *sinks):
+		"""Collects wall and CPU time per stage and counters (lines parsed,
+		moves split, segments emitted, compensator calls, bytes written...)
+		from this module and the compensation scripts while enabled, as a
+		context manager. On exit, the results are reported to each sink
+		(see LogSink, JSONSink and ProfileSink). Example:
+		  with gcode.Instrumentation(gcode.LogSink(), gcode.JSONSink('stats.json')):
+		    compensate_z_3d(...)
+		Only one can be enabled at a time. While none is, instrumented code
+		only checks the module's instrumentation global. Work done in other
+		processes (GcodeParallel workers) is not counted."""
+		self.sinks = sinks
+		self.stages = collections.OrderedDict() #name: [calls, wall time, CPU time]
+		self.counters = collections.OrderedDict()
+
+	def __enter__(self):
+		global instrumentation
+		if instrumentation is not None:
+			raise ValueError('Another Instrumentation is already enabled.')
+		instrumentation = self
+		for sink in self.sinks:
+			sink.start(self)
+		return self
+
+	def __exit__(self, *exc_info):
+		global instrumentation
+		instrumentation = None
+		for sink in self.sinks:
+			sink.finish(self)
+
+	def count(self, name, n=1):
+		"""Add n to the named counter."""
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		"""Context manager adding the time spent in it to the named stage."""
+		wall, cpu = time.time(), cpu_time()
+		try:
+			yield
+		finally:
+			self.add_time(name, time.time() - wall, cpu_time() - cpu)
+
+	def add_time(self, name, wall, cpu=0.0):
+		"""Add one call taking wall and cpu seconds, timed elsewhere (such as
+		waits on a queue), to the named stage."""
+		totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+		totals[0] += 1
+		totals[1] += wall
+		totals[2] += cpu
+
+	def report(self):
+		"""Return the stage times and counters collected as a dict."""
+		return {
+			'stages': collections.OrderedDict((name, {'calls': calls, 'wall': wall, 'cpu': cpu})
+				for name, (calls, wall, cpu) in self.stages.items()),
+			'counters': self.counters,
+			}
+
+class NullStage(object):
+	"""Stage context manager used while instrumentation is disabled."""
+	def __enter__(self):
+		pass
+
+	def __exit__(self, *exc_info):
+		pass
+
+NULL_STAGE = NullStage()
+
+def stage(name):
+	"""Return a context manager timing the named stage in the enabled
+	Instrumentation, if any. Example:
+	  with gcode.stage('compensate'):
+	    g.z_compensate(compensator)"""
+	return instrumentation.stage(name) if instrumentation else NULL_STAGE
+
+def cpu_time():
+	"""Return the user and system CPU time used by this process so far."""
+	times = os.times()
+	return times[0] + times[1]
+
+class LogSink(object):
+	def __init__(self, stream=None):
+		"""Instrumentation sink writing a one line summary to stream
+		(defaults to stderr)."""
+		self.stream = stream
+
+	def start(self, instrumentation):
+		pass
+
+	def finish(self, instrumentation):
+		stages = ['%s %.3fs wall %.3fs cpu' % (name, wall, cpu)
+				for name, (calls, wall, cpu) in instrumentation.stages.items()]
+		counters = ['%s=%d' % item for item in instrumentation.counters.items()]
+		(self.stream or sys.stderr).write('gcode: %s; %s\n' % (', '.join(stages), ' '.join(counters)))
+
+class JSONSink(object):
+	def __init__(self, filename):
+		"""Instrumentation sink writing Instrumentation.report() to a JSON
+		file."""
+		self.filename = filename
+
+	def start(self, instrumentation):
+		pass
+
+	def finish(self, instrumentation):
+		with open(self.filename, 'w') as f:
+			json.dump(instrumentation.report(), f, indent=2)
+
+class ProfileSink(object):
+	def __init__(self, filename):
+		"""Instrumentation sink running cProfile while enabled and dumping
+		its stats to filename, for pstats or other profile viewers."""
+		self.filename = filename
+		self.profile = None
+
+	def start(self, instrumentation):
+		self.profile = cProfile.Profile()
+		self.profile.enable()
+
+	def finish(self, instrumentation):
+		self.profile.disable()
+		self.profile.dump_stats(self.filename)
+
+def read_lines(filename):
+	"""Generator yielding the lines of a gcode file one at a time, with
+	line endings stripped."""
+	with open_gcode(filename) as f:
+		for l in f:
+			yield l[:-1] if l.endswith('\n') else l
+
+def compression(filename):
+	"""Return the compressed file suffix filename ends with (see
+	CODEC_COMMANDS), or None if it is not compressed."""
+	for suffix in CODEC_COMMANDS:
+		if filename.endswith(suffix):
+			return suffix
+	return None
+
+def is_gcode_filename(filename):
+	"""Return whether filename is a .gcode file, possibly compressed."""
+	return filename.endswith('.gcode' + (compression(filename) or ''))
+
+def output_filename(filename, tag):
+	"""Return the name of the output file for a .gcode file, with tag
+	added before the extension, compressed in the same way. Example:
+	  output_filename('part.gcode.gz', '_compensated') == 'part_compensated.gcode.gz'"""
+	suffix = compression(filename) or ''
+	return filename[0:-len('.gcode' + suffix)] + tag + '.gcode' + suffix
+
+def open_gcode(filename, mode='r'):
+	"""Open a gcode file for reading ('r') or writing ('w'), decompressing
+	or compressing it if its name ends with a suffix in CODEC_COMMANDS.
+	Compressed files are handled by a CodecPipe to the first of the
+	suffix's commands found on the PATH, so the codec runs alongside
+	parsing and compensation; gzip files fall back to the gzip module."""
+	if not mode in ('r', 'w'):
+		raise ValueError("Unexpected mode. Expecting 'r' or 'w'.")
+	suffix = compression(filename)
+	if suffix is None:
+		return open(filename, 'w', WRITE_BUFFER_SIZE) if mode == 'w' else open(filename)
+	for command in CODEC_COMMANDS[suffix]:
+		path = find_executable(command)
+		if path:
+			return CodecPipe(path, filename, mode, COMPRESS_LEVELS[suffix])
+	if suffix == '.gz':
+		return gzip.open(filename, mode + 'b', COMPRESS_LEVELS[suffix])
+	raise ValueError('Unexpected compressed file %s. Expecting %s on the PATH.' % (
+			filename, ' or '.join(CODEC_COMMANDS[suffix])))
+
+class CodecPipe(object):
+	def __init__(self, command, filename, mode='r', level=None):
+		"""File object reading the decompressed contents of filename from
+		command (mode 'r'), or writing to filename compressed by command at
+		the given level (mode 'w'). command is any gzip-like program taking
+		-d, -c and -<level>. It runs as a separate process, so its work
+		overlaps with whatever reads or writes the pipe."""
+		self.command = command
+		self.filename = filename
+		self.position = 0 #uncompressed bytes written, see tell()
+		self.output = None
+		self.finished = False #read to the end, or writing
+		if mode == 'r':
+			self.process = subprocess.Popen([command, '-d', '-c', filename],
+					stdout=subprocess.PIPE, bufsize=WRITE_BUFFER_SIZE)
+			self.file = self.process.stdout
+		else:
+			self.output = open(filename, 'wb')
+			self.process = subprocess.Popen([command, '-c', '-%d' % level],
+					stdin=subprocess.PIPE, stdout=self.output, bufsize=WRITE_BUFFER_SIZE)
+			self.file = self.process.stdin
+			self.finished = True
+
+	def __repr__(self):
+		return '<CodecPipe %s for %s>' % (self.process.pid, self.filename)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def __iter__(self):
+		for l in self.file:
+			yield l
+		self.finished = True
+
+	def read(self, size=-1):
+		data = self.file.read(size)
+		if size < 0 or not data:
+			self.finished = True
+		return data
+
+	def readline(self):
+		l = self.file.readline()
+		if not l:
+			self.finished = True
+		return l
+
+	def write(self, s):
+		self.file.write(s)
+		self.position += len(s)
+
+	def tell(self):
+		return self.position
+
+	def close(self):
+		"""Close the pipe and wait for the command to exit. Raises IOError
+		if it failed, unless reading stopped before the end of the file."""
+		if self.file.closed:
+			return
+		if not self.finished:
+			self.process.terminate()
+		self.file.close()
+		status = self.process.wait()
+		if self.output:
+			self.output.close()
+		if status and self.finished:
+			raise IOError('Unexpected exit status %d from %s for %s.' % (
+					status, os.path.basename(self.command), self.filename))
+
+class ModalWriter(object):
+	def __init__(self, f, precision=None, comments=False):
+		"""File object compacting the gcode written to it before passing it
+		on to the file object f, see Gcode.construct(modal=True). The
+		printer's modal state is tracked line by line, and whatever would
+		not change it is dropped:
+		  - X, Y and Z of G0/G1 moves already at that coordinate (absolute
+		    positioning only; coordinates are unknown after G91, and after
+		    G92, G28 or other G codes naming them)
+		  - F equal to the feedrate last given on the same code (G0 and G1
+		    may keep separate feedrates depending on the firmware), until a
+		    G code that may change it such as G28 or G10
+		  - E0 with relative extrusion (M83, or G91 on firmware where it
+		    applies to E too)
+		  - moves left with no arguments, and empty lines
+		  - comments, unless comments is True (Cura's LAYER comments are
+		    always kept, they mark the layers when the file is read again)
+		The arguments of moves are written in their shortest form, to the
+		12 significant digits str() writes without trailing zeros. X, Y, Z
+		and F are rounded to precision decimals first, if given; E is not,
+		as rounding errors add up with relative extrusion. Other arguments
+		are never dropped, and other lines are only stripped of their
+		comments."""
+		self.f = f
+		self.precision = precision
+		self.comments = comments
+		self.position = {'X': None, 'Y': None, 'Z': None} #formatted, None while unknown
+		self.feedrate = None #(code, formatted F) last given
+		self.absolute = True
+		self.relative_e = False #M83, else M82 (the firmware default) or not given
+		self.formatted = {} #(value, precision): shortest form, see format_value()
+		self.partial = '' #written after the last line ending
+		self.lines_in = 0
+		self.lines_out = 0
+
+	def __repr__(self):
+		return '<ModalWriter to %r>' % self.f
+
+	def write(self, s):
+		lines = (self.partial + str(s)).split('\n')
+		self.partial = lines.pop()
+		out = [l for l in itertools.imap(self.compact_line, lines) if l is not None]
+		self.lines_in += len(lines)
+		if out:
+			self.lines_out += len(out)
+			self.f.write('\n'.join(out) + '\n')
+
+	def flush(self):
+		"""Write out any last line not ended by a line ending."""
+		if self.partial:
+			l = self.compact_line(self.partial)
+			self.partial = ''
+			self.lines_in += 1
+			if l is not None:
+				self.lines_out += 1
+				self.f.write(l)
+
+	def format_value(self, value, precision=None):
+		"""Return the shortest form of a numeric argument value (a string),
+		rounded to precision decimals if given, or the value as it was if it
+		is not a number."""
+		if not '.' in value:
+			return value
+		key = (value, precision)
+		if key in self.formatted:
+			return self.formatted[key]
+		try:
+			number = float(value)
+		except ValueError:
+			return value
+		if precision is None:
+			value = str(number)
+			if 'e' in value: #G-code has no exponents
+				value = '%.12f' % number
+		else:
+			value = '%.*f' % (precision, number)
+		if '.' in value:
+			value = value.rstrip('0').rstrip('.')
+		if value == '-0':
+			value = '0'
+		if len(self.formatted) < 100000:
+			self.formatted[key] = value
+		return value
+
+	def compact_line(self, l):
+		"""Return the compacted line, or None to drop it."""
+		if l.lstrip()[:1] == ';': #comment-only line
+			return l if self.comments or CURA_LAYER.match(l) else None
+		comment = ''
+		if ';' in l:
+			l, comment = l.split(';', 1)
+			comment = ' ;' + comment if self.comments else ''
+		tokens = l.split()
+		if not tokens:
+			return None
+		code = tokens[0]
+		if code in RAW_ARG_CODES:
+			return l.rstrip() + comment
+
+		if code in ('G0', 'G1'):
+			out = [code]
+			for arg in tokens[1:]:
+				letter = arg[0]
+				if len(arg) == 1 or not letter in 'XYZFE':
+					out.append(arg)
+					continue
+				value = self.format_value(arg[1:], None if letter == 'E' else self.precision)
+				if letter in self.position:
+					if not self.absolute:
+						self.position[letter] = None
+					elif self.position[letter] == value:
+						continue
+					else:
+						self.position[letter] = value
+				elif letter == 'F':
+					if self.feedrate == (code, value):
+						continue
+					self.feedrate = (code, value)
+				elif value == '0' and (self.relative_e or not self.absolute):
+					continue
+				out.append(letter + value)
+			if len(out) == 1:
+				return comment.lstrip() or None
+			return ' '.join(out) + comment
+
+		if code == 'G90':
+			self.absolute = True
+		elif code == 'G91':
+			self.absolute = False
+		elif code == 'M82':
+			self.relative_e = False
+		elif code == 'M83':
+			self.relative_e = True
+		elif code[:1] == 'G':
+			#G92 sets, G28 homes and anything else may move the axes it names (all for G28 and G92 alone)
+			axes = [arg[0] for arg in tokens[1:] if arg[0] in self.position]
+			if len(tokens) == 1 and code in ('G28', 'G92'):
+				axes = self.position.keys()
+			for axis in axes:
+				self.position[axis] = None
+			if not code in ('G4', 'G92'):
+				self.feedrate = None
+		return ' '.join(tokens) + comment
+
+def iter_layers(lines, split=True):
+	"""Generator splitting an iterable of gcode lines into layers as they
+	are read. The first item yielded is always the preamble (None if there
+	is none), followed by one Layer per layer, each yielded as soon as the
+	start of the next layer is seen. split is passed on to Layer()."""
+	return parse_layers(iter_layer_lines(lines), split)
+
+def iter_minimal_layers(lines):
+	"""Same as iter_layers(), yielding MinimalLayers."""
+	return parse_minimal_layers(iter_layer_lines(lines))
+
+def parse_layers(layer_lines, split=True):
+	"""Same as iter_layers(), from an iterable of lists of lines, one per
+	layer, as iter_layer_lines() yields them."""
+	layer_lines = iter(layer_lines)
+	preamble = make_preamble(next(layer_lines))
+	yield preamble
+	prev_final_pt = preamble.get_final_point() if preamble else Point(0,0,0)
+	for layernum, curr_layer in enumerate(layer_lines, 1):
+		layer = Layer(prev_final_pt, curr_layer, split=split, layernum=layernum)
+		prev_final_pt = layer.get_final_point()
+		yield layer
+
+def parse_minimal_layers(layer_lines):
+	"""Same as parse_layers(), yielding MinimalLayers."""
+	layer_lines = iter(layer_lines)
+	preamble = next(layer_lines)
+	yield MinimalLayer(preamble, layernum=0) if preamble else None
+	for layernum, curr_layer in enumerate(layer_lines, 1):
+		yield MinimalLayer(curr_layer, layernum=layernum)
+
+def source_line(line):
+	"""Return the text a Line was parsed from, which parses back into the
+	same Line (construct() does not always, e.g. for RAW_ARG_CODES)."""
+	if line.code is None or line.comment is None:
+		return line.line
+	return line.line + ';' + line.comment
+
+def make_preamble(lines):
+	"""Return the preamble Layer for the given lines, None if there are none."""
+	if not lines:
+		return None
+	return Layer(
+		Point(0,0,0),
+		lines,
+		split=False,
+		layernum=0,
+		explicit=False) #do not split preamble (not compensating anyway)
+
+def iter_layer_lines(lines):
+	"""Generator splitting an iterable of gcode lines into lists of lines,
+	one per layer, without parsing them. The first list yielded is always
+	the preamble (possibly empty)."""
+	in_preamble = True
+	curr_layer = []
+	for l, starts_layer in iter_layer_breaks(lines):
+		if starts_layer:
+			if in_preamble or curr_layer:
+				yield curr_layer
+			in_preamble = False
+			curr_layer = [] if CURA_LAYER.match(l) else [l] #Cura's LAYER comments are dropped
+		elif l: #skip empty lines
+			curr_layer.append(l)
+
+	if in_preamble or curr_layer:
+		yield curr_layer
+
+def iter_layer_breaks(lines):
+	"""Generator yielding (l, starts_layer) for every line of an iterable
+	of gcode lines, starts_layer being True for the lines where a new layer
+	starts (the first layer after the preamble included), see
+	iter_layer_lines()."""
+	in_preamble = True
+	in_raft = True
+	cura = False #switch to Cura's "LAYER" comments once we see one
+	for l in lines:
+		if not l:
+			yield l, False
+			continue
 
 		#Cura nicely adds a "LAYER" comment just before each layer
-		if ';LAYER:' in filestring:
-			#Split into layers
-			splits = re.split(r'^;LAYER:\d+\n', filestring, flags=re.M)
-			self.preamble = Layer(splits[0].split('\n'), layernum=0)
-			self.layers = [Layer(l.split('\n'), layernum=i) for i,l in
-					enumerate(splits[1:])]
-	
+		if CURA_LAYER.match(l):
+			cura = True
+			is_layer_change = True
 		#Sliced with Slic3r, so no LAYER comments; we have to look for
 		# G0 or G1 commands with a Z in them
 		else:
-			layernum = 1
-			curr_layer = []
-			for l in filestring.split('\n'):
-				if not l: #skip empty lines
-					continue
-				#Looks like a layer change because we have a Z
-				if re.match(r'G[01]\s+Z-?\.?\d+', l): 
-					if in_preamble:
-						if not in_raft:
-							self.preamble = Layer(
-							Point(0,0,0), 
-							curr_layer, 
-							split=False, 
-							layernum=0, 
-							explicit=False) #do not split preamble (not compensating anyway)
-							in_preamble = False #preamble ends at 1st layer change after raft end
-						else:
-							curr_layer.append(l) #append to preamble if still in raft
-							continue #skip rest of loop
-					else:
-						if len(self.layers) == 0:
-							self.layers.append(Layer(
-								self.preamble.get_final_point(), 
-								curr_layer, 
-								layernum=layernum))
-						else:
-							self.layers.append(Layer(
-								self.layers[-1].get_final_point(),
-								curr_layer, 
-								layernum=layernum))
-						layernum =+ 1
-					curr_layer = [l]
-
-				#Not a layer change so add it to the current layer
-				else:
-					curr_layer.append(l)
-					if l == '; END RAFT':
-						in_raft = False # exit raft once END RAFT flag detected
-
-			self.layers.append(Layer(
-				self.layers[-1].get_final_point(), 
-				curr_layer, 
-				layernum=layernum))
+			is_layer_change = bool(not cura and LAYER_CHANGE.match(l))
+
+		#Looks like a layer change because we have a Z
+		if is_layer_change:
+			if in_preamble and in_raft and not cura:
+				is_layer_change = False #part of the preamble if still in raft
+			else:
+				in_preamble = False #preamble ends at 1st layer change after raft end
+		elif l == '; END RAFT':
+			in_raft = False # exit raft once END RAFT flag detected
+
+		yield l, is_layer_change
 
 if __name__ == "__main__":
 	if sys.argv[1:]: